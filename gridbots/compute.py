@@ -5,6 +5,7 @@
 
 import os
 import sys
+import argparse
 
 # If gridbots not in python path, add it -
 # This allows running this script directly
@@ -13,15 +14,43 @@ if gb_pythonpath not in sys.path:
     sys.path.append(gb_pythonpath)
 
 from gridbots.core.simulation import Simulation
+from gridbots.core.parallel import ParallelRun
 
 
 if __name__ == '__main__':
 
-    try:
-        sim_name = sys.argv[1]
-    except IndexError:
-        print('Usage: python -m gridbots.compute [sim_name]')
-        sys.exit(1)
-
-    sim = Simulation(sim_name)
-    paths_name = sim.run()
+    parser = argparse.ArgumentParser(description='Simulate a gridbots routine and write its paths.')
+    parser.add_argument('sim_name', help='name of a simulation in spec/simulations')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='keep the paths of the previous run up to the first frame affected by edited scripts'
+    )
+    parser.add_argument(
+        '--stats-only', action='store_true',
+        help='write summary stats to spec/stats instead of recording paths'
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='continue from the latest checkpoint of an interrupted run'
+    )
+    parser.add_argument(
+        '--start-frame', type=int,
+        help='continue from the latest checkpoint at or before this frame'
+    )
+    parser.add_argument(
+        '--parallel', type=int, metavar='PROCESSES',
+        help='simulate segments of the routine in this many processes (0 for one per core)'
+    )
+    args = parser.parse_args()
+
+    sim = Simulation(
+        args.sim_name,
+        incremental=args.incremental,
+        stats_only=args.stats_only,
+        resume=args.resume,
+        start_frame=args.start_frame
+    )
+    if args.parallel is not None:
+        paths_name = ParallelRun(sim, args.parallel).run()
+    else:
+        paths_name = sim.run()
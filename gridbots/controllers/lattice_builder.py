@@ -59,24 +59,33 @@ class LatticeController():
 
         self.mode = 'uninit'
 
-        # Generate the build commands
-        self.commands = []
-        self.generate_commands()
-
-        script_str = '\n'.join(self.commands)
-        self.logger.info(script_str)
-
         script_dir = os.path.join(gridbots.path, 'sri-scripts')
         script_name = '_{}.txt'.format(self.sim.sim_name)
         script_path = os.path.join(script_dir, script_name)
 
-        with open(script_path, 'w') as f:
-            f.write(script_str)
+        # Generate the build commands, unless running the script written by an
+        # earlier run, as the workers of a parallel run do
+        self.commands = []
+        if options.get('generate', True):
+            self.generate_commands()
+
+            script_str = '\n'.join(self.commands)
+            self.logger.info(script_str)
+
+            # Write to a temporary file first so readers never see a partial script
+            tmp_path = '{}.{}.tmp'.format(script_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(script_str)
+            os.replace(tmp_path, script_path)
 
         # Use a RoutineController to read and run the script
         self.routine_controller = RoutineController(self.sim, {
-            'routine': script_name
+            'routine': script_name,
+            'lazy': options.get('lazy', False),
+            'optimize': options.get('optimize', False),
+            'inline_scripts': options.get('inline_scripts', False)
         })
+        self.builder = self.routine_controller.builder
 
     def comment(self, s):
         self.commands.append('# {}'.format(s))
@@ -482,8 +491,12 @@ class LatticeController():
 
     def step(self, frame):
 
-        if frame >= len(self.routine_controller.routine):
-            self.finished = True
-            return {}
+        control_inputs = self.routine_controller.step(frame)
+        self.finished = self.routine_controller.finished
+        return control_inputs
+
+    def step_span(self, frame):
 
-        return self.routine_controller.step(frame)
+        control_inputs, frames = self.routine_controller.step_span(frame)
+        self.finished = self.routine_controller.finished
+        return control_inputs, frames
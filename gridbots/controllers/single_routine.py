@@ -17,14 +17,66 @@ class RoutineController():
         self.routine_name = options['routine']
         self.finished = False
 
+        # In lazy mode, control inputs are generated frame by frame as the
+        # simulation runs instead of expanding the whole routine up front
+        self.lazy = options.get('lazy', False)
+
         script_dir = os.path.join(gridbots.path, 'sri-scripts')
-        builder = TrajectoryBuilder(script_dir, self.routine_name)
+        builder = TrajectoryBuilder(
+            script_dir, self.routine_name,
+            lazy=self.lazy,
+            optimize=options.get('optimize', False),
+            inline_scripts=options.get('inline_scripts', False)
+        )
+        self.builder = builder
         self.routine = builder.moves
 
+        # In lazy mode, the current segment and the frame it starts at
+        self.segments = builder.iter_segments(builder.commands) if self.lazy else None
+        self.segment = ({}, 0)
+        self.segment_start = 0
+
     def step(self, frame):
 
+        control_inputs, frames = self.step_span(frame)
+        return control_inputs
+
+    def step_span(self, frame):
+        """
+        Return the control inputs for the given frame, and the number of frames
+        from it that have the same inputs. Returns no inputs and zero frames
+        once the routine is finished.
+        """
+
+        if self.lazy:
+            return self.step_span_lazy(frame)
+
         if frame >= len(self.routine):
             self.finished = True
-            return {}
+            return {}, 0
+
+        # Segment lookup by binary search
+        return self.routine.span(frame)
+
+    def step_span_lazy(self, frame):
+
+        if frame < self.segment_start:
+            raise Exception('Lazy routine must be stepped in order, expected frame {} or later, got {}'.format(
+                self.segment_start, frame
+            ))
+
+        # Skip ahead to the segment containing the frame
+        control_inputs, count = self.segment
+        while frame >= self.segment_start + count and not self.finished:
+            self.segment_start += count
+            try:
+                control_inputs, count = next(self.segments)
+            except StopIteration:
+                self.finished = True
+                control_inputs, count = {}, 0
+            self.segment = control_inputs, count
+
+        if self.finished:
+            return {}, 0
 
-        return self.routine[frame]
+        return control_inputs, self.segment_start + count - frame
@@ -4,10 +4,122 @@
 
 import math
 import logging
-from operator import itemgetter
 
 import mathutils as mu
 
+from gridbots.utils.maputils import NodeTable, transition_table
+
+
+def move_direction(c0, c1):
+    """
+    Unit vector in the XY plane from position c0 to c1.
+    """
+
+    v1 = c1 - c0
+    return mu.Vector([v1.x, v1.y, 0]).normalized()
+
+
+def rotation_change(v0, v1):
+    """
+    Change in rotation of a bot whose last move was along unit vector v0 and
+    that now moves along a different unit vector v1.
+    """
+
+    v0p = mu.Vector([v0.y, -v0.x, 0])
+
+    d1 = v0.dot(v1)
+    d2 = v0p.dot(v1)
+
+    # Axis of rotation, whether along v0 or perpendicular to it
+    v_rot = v0 if abs(d1) > abs(d2) else v0p
+
+    # Direction
+    v_rot = v_rot if d1 > 0 else -v_rot
+
+    theta = v_rot.rotation_difference(v1).to_euler().z
+
+    if d1 == 0:
+        theta = 0
+
+    return theta
+
+
+class RotationTable():
+    """
+    Rotation model of a map as lookup tables. Moves only go along a handful of
+    unit vectors (+/-X, +/-Y and the diagonals of rotational pixels), so each
+    distinct one gets a direction ID, and the change in rotation between every
+    pair of directions is computed once with rotation_change.
+
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, node_table, transitions):
+
+        # Unit vector of each direction ID
+        self.dirs = []
+
+        # Direction ID of the move between each pair of node indices
+        self.move_dirs = {}
+
+        for node, moves in transitions.items():
+            n1 = node_table.index[node]
+            for directions in moves.values():
+                for node2 in directions.values():
+                    n2 = node_table.index[node2]
+                    v = move_direction(node_table.mm[n1], node_table.mm[n2])
+                    self.move_dirs[(n1, n2)] = self.dir_id(v)
+
+        # Change in rotation from each direction to each other one, and the
+        # turns of more than 90 degrees
+        self.turns = [[0] * len(self.dirs) for v in self.dirs]
+        self.wide = set()
+        for d0, v0 in enumerate(self.dirs):
+            for d1, v1 in enumerate(self.dirs):
+                if d0 != d1:
+                    theta = rotation_change(v0, v1)
+                    self.turns[d0][d1] = theta
+                    if theta > math.pi/2:
+                        self.wide.add((d0, d1))
+
+    def __getstate__(self):
+
+        # Vectors can't be pickled, so directions are sent to worker processes
+        # as tuples
+        return dict(self.__dict__, dirs=[tuple(v) for v in self.dirs])
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.dirs = [mu.Vector(v) for v in state['dirs']]
+
+    def dir_id(self, v):
+
+        # Same comparison as between the move vectors themselves
+        for d, dir_v in enumerate(self.dirs):
+            if v == dir_v:
+                return d
+
+        self.dirs.append(v)
+        return len(self.dirs) - 1
+
+    def turn(self, d0, d1):
+        """
+        Change in rotation from a move in direction d0 to one in direction d1.
+        """
+
+        if (d0, d1) in self.wide:
+            self.warn(d0, d1)
+
+        return self.turns[d0][d1]
+
+    def warn(self, d0, d1):
+
+        self.logger.warning('v0_u = %s, v1_u = %s', self.dirs[d0], self.dirs[d1])
+        self.logger.warning('Rotation theta > pi/2! theta = %s', self.turns[d0][d1])
+        # raise Exception('Invalid rotation, theta = {}'.format(theta))
+
 
 class Bot:
     """
@@ -17,7 +129,8 @@ class Bot:
 
     logger = logging.getLogger(__name__)
 
-    def __init__(self, name, node, rotation, bot_type, graph):
+    def __init__(self, name, node, rotation, bot_type, graph, transitions=None, node_table=None,
+                 rotation_table=None):
 
         # Bot name
         self.name = str(name)
@@ -25,22 +138,30 @@ class Bot:
         # Bot type
         self.type = bot_type
 
-        # Current node
-        self.node = node
-
-        # Last movement vector (for rotation calc)
-        self.last_move_vector = None
+        # Direction ID of the last move (for rotation calc)
+        self.last_move_dir = None
 
         # Save a reference to the simulation
         self.graph = graph
 
-        # Handy for getting the position from the node
-        # self.xyz_getter(self.graph.node[self.node])
-        self.xyz_getter = itemgetter('x', 'y', 'z')
+        # Next node for each zone move, from maputils.transition_table
+        if transitions is None:
+            transitions = transition_table(graph)
+        self.transitions = transitions
+
+        # Coordinates of each node, from maputils.NodeTable
+        if node_table is None:
+            node_table = NodeTable(graph)
+        self.node_table = node_table
+
+        # Direction of each move and change in rotation between directions
+        if rotation_table is None:
+            rotation_table = RotationTable(node_table, transitions)
+        self.rotation_table = rotation_table
 
-        # Position (coordinates)
-        # Directly calculable from the current node
-        self.pos = self.node_to_pos(self.node)
+        # Current node, its index in the node table, and its position in mm
+        # and in grid units, which are shared with the table
+        self.set_node(node)
         self.last_pos = None
 
         # Current orientation
@@ -53,7 +174,28 @@ class Bot:
         self.last_pos = None
 
     def node_to_pos(self, node):
-        return mu.Vector(self.xyz_getter(self.graph.node[self.node])) * 24
+        return self.node_table.mm[self.node_table.index[node]]
+
+    def set_node(self, node):
+
+        self.node = node
+        self.node_id = self.node_table.index[node]
+        self.pos = self.node_table.mm[self.node_id]
+        self.grid_pos = self.node_table.grid[self.node_id]
+
+    def get_state(self):
+        """ Everything about the bot that changes as it moves, as plain
+            data for a checkpoint.
+        """
+        last_pos = tuple(self.last_pos) if self.last_pos is not None else None
+        return self.node, self.rot, self.last_move_dir, last_pos
+
+    def set_state(self, state):
+        """ Restore the bot from get_state data.
+        """
+        node, self.rot, self.last_move_dir, last_pos = state
+        self.set_node(node)
+        self.last_pos = mu.Vector(last_pos) if last_pos is not None else None
 
     def __repr__(self):
         """ String representation of the bot.
@@ -64,55 +206,26 @@ class Bot:
             self.node
         )
 
-    def rotate(self):
-        """ Change rotation as needed, based on the current position
-            and the move history.
+    def rotate(self, n1):
+        """ Change rotation as needed, based on the move from node index
+            n1 to the current node and the move history.
         """
 
-        if not self.last_pos:
-            return
-
-        c0 = self.last_pos
-        c1 = self.pos
-
-        v0 = self.last_move_vector
-        v1 = c1 - c0
-        v1 = mu.Vector([v1.x, v1.y, 0]).normalized()
+        d0 = self.last_move_dir
+        d1 = self.rotation_table.move_dirs[(n1, self.node_id)]
 
         # Can't make rotation decision if we have no data
-        if v0 is None:
-            self.last_move_vector = v1
+        if d0 is None:
+            self.last_move_dir = d1
             return
 
-        # No need to do calculations if movement in same direction
-        if v0 == v1:
+        # No rotation if movement in same direction
+        if d0 == d1:
             return
 
-        v0p = mu.Vector([v0.y, -v0.x, 0])
-
-        d1 = v0.dot(v1)
-        d2 = v0p.dot(v1)
-
-        # Axis of rotation, whether along v0 or perpendicular to it
-        v_rot = v0 if abs(d1) > abs(d2) else v0p
+        self.rot += self.rotation_table.turn(d0, d1)
 
-        # Direction
-        v_rot = v_rot if d1 > 0 else -v_rot
-
-        theta = v_rot.rotation_difference(v1).to_euler().z
-
-        if d1 == 0:
-            theta = 0
-
-        if theta > math.pi/2:
-            self.logger.warning('v0_u = %s, v1_u = %s', v0, v1)
-            self.logger.warning('v_rot = %s, d1 = %s', v_rot, d1)
-            self.logger.warning('Rotation theta > pi/2! theta = %s', theta)
-            # raise Exception('Invalid rotation, theta = {}'.format(theta))
-
-        self.rot += theta
-
-        self.last_move_vector = v1
+        self.last_move_dir = d1
 
     def update(self, control_inputs):
         """
@@ -122,29 +235,23 @@ class Bot:
         # Logging header
         # self.logger.debug('################### Bot %s'.format(self.name, self.node))
 
-        moves_to_make = []
-
-        # TODO return if only waiting
-
-        # Line below is optimized w/ low-level nx access since this is a critical region
-        for n2, edge_data in self.graph.adj[self.node].items():
-            for zone in edge_data.keys():
-                if zone in control_inputs:
-                    if edge_data[zone] == control_inputs[zone]:
-                        # self.logger.debug('Bot %s can move from %s to %s'.format(self.name, n1, n2))
-                        moves_to_make.append(n2)
-
-        if len(moves_to_make) > 1:
-            if len(set(moves_to_make)) != 1:
-                raise Exception('Multiple moves possible for bot {}: {}'.format(self.name, moves_to_make))
+        new_node = None
 
-        if len(moves_to_make) > 0:
+        # One lookup per zone with edges out of this node. The map was checked
+        # for ambiguous and self moves when the table was built, so only
+        # driving two zones at once can give conflicting moves here.
+        for zone, moves in self.transitions[self.node].items():
+            if zone in control_inputs:
+                n2 = moves.get(control_inputs[zone])
+                if n2 is not None:
+                    if new_node is not None and n2 != new_node:
+                        raise Exception('Multiple moves possible for bot {}: {}'.format(self.name, [new_node, n2]))
+                    # self.logger.debug('Bot %s can move from %s to %s'.format(self.name, n1, n2))
+                    new_node = n2
 
-            new_node = moves_to_make[0]
-            if new_node == self.node:
-                raise Exception('Bot {} moving to same node {}!'.format(self.name, self.node))
+        if new_node is not None:
 
-            self.node = new_node
+            n1 = self.node_id
             self.last_pos = self.pos
-            self.pos = self.node_to_pos(self.node)
-            self.rotate()
+            self.set_node(new_node)
+            self.rotate(n1)
@@ -0,0 +1,250 @@
+"""
+
+"""
+
+import logging
+
+import numpy as np
+
+
+class BotArray():
+    """
+    Array-backed state of all bots, stepped for the whole fleet at once. Zone
+    moves are looked up in a dense (node, zone direction) -> next node array,
+    so a frame is one fancy-indexing operation over all bots. The Bot objects
+    are only brought up to date by sync(), when something reads them.
+
+    """
+
+    def __init__(self, bots, node_table, transitions, rotation_table):
+
+        self.logger = logging.getLogger(__name__)
+
+        self.bots = bots
+
+        # Nodes are numbered as in the node table
+        self.nodes = node_table.nodes
+        self.node_index = node_table.index
+
+        # Column of each zone direction, by zone and then direction
+        zone_dirs = sorted({
+            (zone, direction)
+            for moves in transitions.values()
+            for zone, directions in moves.items()
+            for direction in directions
+        })
+        self.zone_columns = {}
+        for column, (zone, direction) in enumerate(zone_dirs):
+            self.zone_columns.setdefault(zone, {})[direction] = column
+
+        # Index of the next node for each node and zone direction, or -1,
+        # and the direction ID of that move
+        self.next_node = np.full((len(self.nodes), len(zone_dirs)), -1, dtype=np.int32)
+        self.next_dir = np.full((len(self.nodes), len(zone_dirs)), -1, dtype=np.int32)
+        for node, moves in transitions.items():
+            n1 = self.node_index[node]
+            for zone, directions in moves.items():
+                for direction, node2 in directions.items():
+                    column = self.zone_columns[zone][direction]
+                    n2 = self.node_index[node2]
+                    self.next_node[n1, column] = n2
+                    self.next_dir[n1, column] = rotation_table.move_dirs[(n1, n2)]
+
+        # Position of each node in mm
+        self.node_pos = np.array(node_table.mm, dtype=np.float32)
+
+        # Change in rotation between each pair of directions, whether it is a
+        # float, and whether it is a turn of more than 90 degrees
+        self.rotation_table = rotation_table
+        turns = rotation_table.turns
+        self.turns = np.array(turns, dtype=float).reshape(len(turns), len(turns))
+        self.float_turns = np.array([[isinstance(t, float) for t in row] for row in turns], dtype=bool)
+        self.float_turns = self.float_turns.reshape(self.turns.shape)
+        self.wide_turns = np.zeros(self.turns.shape, dtype=bool)
+        for d0, d1 in rotation_table.wide:
+            self.wide_turns[d0, d1] = True
+
+        # Jump tables of each zone direction column, built when first used
+        self.jump_tables = {}
+
+        # State of each bot
+        self.node_ids = np.array([self.node_index[b.node] for b in bots], dtype=np.int32)
+        self.rot = np.array([b.rot for b in bots], dtype=float)
+
+        # Whether a float turn was added to each rotation. Bot.rotate turns an
+        # integer rotation into a float that way, even when adding 0.0.
+        self.rot_changed = np.zeros(len(bots), dtype=bool)
+
+        self.last_dir = np.array([
+            -1 if b.last_move_dir is None else b.last_move_dir
+            for b in bots
+        ], dtype=np.int32)
+
+        # Bots that moved since the last sync
+        self.dirty = set()
+
+    def positions(self):
+        """
+        Position of each bot in mm.
+        """
+        return self.node_pos[self.node_ids]
+
+    def update(self, control_inputs):
+        """
+        Move every bot in a driven zone for this time step.
+        """
+
+        columns = []
+        for key, value in control_inputs.items():
+            zone_columns = self.zone_columns.get(key)
+            if zone_columns is not None and value in zone_columns:
+                columns.append(zone_columns[value])
+
+        if not columns:
+            return
+
+        if len(columns) == 1:
+            new_ids = self.next_node[self.node_ids, columns[0]]
+            new_dirs = self.next_dir[self.node_ids, columns[0]]
+        else:
+            # Bots in more than one driven zone must agree on where they go
+            candidates = self.next_node[self.node_ids[:, None], columns]
+            new_ids = candidates.max(axis=1)
+            conflicts = ((candidates >= 0) & (candidates != new_ids[:, None])).any(axis=1)
+            if conflicts.any():
+                i = int(np.nonzero(conflicts)[0][0])
+                raise Exception('Multiple moves possible for bot {}: {}'.format(
+                    self.bots[i].name, [self.nodes[n] for n in sorted(set(candidates[i])) if n >= 0]
+                ))
+            column = np.array(columns)[(candidates >= 0).argmax(axis=1)]
+            new_dirs = self.next_dir[self.node_ids, column]
+
+        moved = np.nonzero(new_ids >= 0)[0]
+        if len(moved) == 0:
+            return
+
+        self.node_ids[moved] = new_ids[moved]
+        self.rotate(moved, new_dirs[moved])
+
+        self.dirty.update(moved.tolist())
+
+    def jump_table(self, column):
+        """
+        Return binary lifting tables for repeating the move of a zone direction
+        column. Entry k of the jumps maps each node to the node reached after
+        2^k moves that all go in the same direction as the first, or -1, and
+        the run is the number of such straight moves possible from each node.
+        """
+
+        if column in self.jump_tables:
+            return self.jump_tables[column]
+
+        next_node = self.next_node[:, column]
+        next_dir = self.next_dir[:, column]
+
+        # A straight run can't be longer than the number of nodes, unless the
+        # map wraps around, in which case it is cut into runs of this length
+        max_levels = len(self.nodes).bit_length() + 1
+
+        jumps = [next_node]
+        while len(jumps) < max_levels:
+            jump = jumps[-1]
+            mid = np.where(jump >= 0, jump, 0)
+            straight = (jump >= 0) & (jump[mid] >= 0) & (next_dir[mid] == next_dir)
+            if not straight.any():
+                break
+            jumps.append(np.where(straight, jump[mid], -1))
+
+        # Longest straight run from each node, taking the largest jumps first
+        run = np.zeros(len(self.nodes), dtype=np.int64)
+        node = np.arange(len(self.nodes))
+        for k in reversed(range(len(jumps))):
+            can = (jumps[k][node] >= 0) & (next_dir[node] == next_dir)
+            run[can] += 1 << k
+            node = np.where(can, jumps[k][node], node)
+
+        self.jump_tables[column] = jumps, run
+        return jumps, run
+
+    def advance(self, control_inputs, frames):
+        """
+        Move every bot in the one driven zone for the given number of frames
+        with the same inputs. Each straight run is jumped over in O(log frames)
+        through the jump tables, with a turn only at its start, as in rotate.
+        """
+
+        column = None
+        for key, value in control_inputs.items():
+            zone_columns = self.zone_columns.get(key)
+            if zone_columns is not None and value in zone_columns:
+                column = zone_columns[value]
+
+        if column is None:
+            return
+
+        jumps, run = self.jump_table(column)
+        next_dir = self.next_dir[:, column]
+
+        left = np.full(len(self.bots), frames, dtype=np.int64)
+        moving = np.nonzero(run[self.node_ids] > 0)[0]
+        self.dirty.update(moving.tolist())
+
+        while len(moving):
+
+            nodes = self.node_ids[moving]
+            steps = np.minimum(left[moving], run[nodes])
+
+            self.rotate(moving, next_dir[nodes])
+
+            for k, jump in enumerate(jumps):
+                bit = (steps >> k) & 1 == 1
+                nodes[bit] = jump[nodes[bit]]
+
+            self.node_ids[moving] = nodes
+            left[moving] -= steps
+
+            # Bots that reached a turn keep going from there
+            moving = moving[(left[moving] > 0) & (run[nodes] > 0)]
+
+    def rotate(self, moved, d1):
+        """
+        Update the rotations of the given bots after moves in directions d1,
+        following Bot.rotate.
+        """
+
+        d0 = self.last_dir[moved]
+
+        # Bots with a previous move that changed direction
+        turning = (d0 >= 0) & (d0 != d1)
+        if turning.any():
+            bots, t0, t1 = moved[turning], d0[turning], d1[turning]
+            self.rot[bots] += self.turns[t0, t1]
+            self.rot_changed[bots] |= self.float_turns[t0, t1]
+
+            wide = self.wide_turns[t0, t1]
+            for w0, w1 in zip(t0[wide].tolist(), t1[wide].tolist()):
+                self.rotation_table.warn(w0, w1)
+
+        self.last_dir[moved] = d1
+
+    def sync(self):
+        """
+        Copy the node, position, rotation and last move of each bot that moved
+        since the last sync into its Bot object.
+        """
+
+        for i in self.dirty:
+
+            bot = self.bots[i]
+
+            node = self.nodes[self.node_ids[i]]
+            if node != bot.node:
+                bot.set_node(node)
+
+            if self.rot_changed[i]:
+                bot.rot = float(self.rot[i])
+
+            d = int(self.last_dir[i])
+            bot.last_move_dir = d if d >= 0 else None
+
+        self.dirty.clear()
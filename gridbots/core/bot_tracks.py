@@ -0,0 +1,224 @@
+"""
+
+"""
+
+import logging
+import multiprocessing
+
+import numpy as np
+
+from gridbots.core.bot import Bot
+
+# Map tables used by integrate_bots, set once in each worker process
+_tables = None
+
+
+def init_worker(transitions, node_table, rotation_table):
+    global _tables
+    _tables = transitions, node_table, rotation_table
+
+
+def integrate_bots(task):
+    """
+    Move each of the given bots on its own through the given spans of zone
+    inputs. Returns the frame, node index, move direction and rotation after
+    every move of each bot, and whether the rotation is a float.
+    """
+
+    states, spans = task
+    transitions, node_table, rotation_table = _tables
+
+    tracks = []
+    for name, state in states:
+
+        bot = Bot(name, state[0], state[1], None, None, transitions, node_table, rotation_table)
+        bot.set_state(state)
+
+        frames, nodes, dirs, rots = [], [], [], []
+        for control_inputs, start, count in spans:
+            for frame in range(start, start + count):
+
+                node = bot.node
+                bot.update(control_inputs)
+
+                # The inputs stay the same for the rest of the span, so a bot
+                # that stays put now stays put for all of it
+                if bot.node == node:
+                    break
+
+                frames.append(frame)
+                nodes.append(bot.node_id)
+                dirs.append(bot.last_move_dir)
+                rots.append(bot.rot)
+
+        tracks.append((
+            np.array(frames, dtype=np.int64),
+            np.array(nodes, dtype=np.int32),
+            np.array(dirs, dtype=np.int32),
+            np.array(rots, dtype=float),
+            np.array([isinstance(r, float) for r in rots], dtype=bool)
+        ))
+
+    return tracks
+
+
+class BotTracks():
+    """
+    Precomputed moves of every bot. A bot's motion only depends on its own node
+    and the control inputs, so the tracks of all bots through the rest of the
+    routine are integrated independently, spread over worker processes, on the
+    first update. After that, a frame costs nothing until something reads the
+    bots, which sync() then looks up in their tracks: recorded states, and the
+    structure when curing or handing out rods. Follows the interface of
+    BotArray.
+
+    """
+
+    # Next move frame of a bot with no moves left
+    NO_MOVE = np.iinfo(np.int64).max
+
+    def __init__(self, sim, processes=None):
+
+        self.logger = logging.getLogger(__name__)
+
+        self.sim = sim
+        self.bots = sim.bots
+        self.node_table = sim.node_table
+
+        self.processes = processes or multiprocessing.cpu_count()
+
+        # Frame the tracks start from, and the frame before which every move
+        # has been made
+        self.start_frame = sim.frame
+        self.frame = sim.frame
+
+        # Node index each bot starts from
+        self.start_nodes = np.array([b.node_id for b in self.bots], dtype=np.int32)
+
+        self.integrated = False
+
+    def spans(self):
+        """
+        Return (zone inputs, start frame, frame count) of every span of the
+        routine in which zones are driven, from the start frame to the end of
+        the simulation.
+        """
+
+        builder = self.sim.controller.builder
+        zones = self.sim.zone_bots
+        end_frame = self.sim.end_frame
+
+        # Expanding the script lazily runs on the rate of the builder, which a
+        # lazy controller is in the middle of using
+        rate = builder.rate
+        if builder.moves is not None:
+            segments = builder.moves.segments()
+        else:
+            builder.rate = builder.DEFAULT_RATE
+            segments = builder.iter_segments(builder.commands)
+
+        spans = []
+        frame = 0
+        for control_inputs, count in segments:
+
+            start = max(frame, self.start_frame)
+            frame += count
+            end = frame if end_frame is None else min(frame, end_frame)
+
+            if start < end:
+                zone_inputs = {key: value for key, value in control_inputs.items() if key in zones}
+                if zone_inputs:
+                    spans.append((zone_inputs, start, end - start))
+
+            if end_frame is not None and frame >= end_frame:
+                break
+
+        builder.rate = rate
+
+        return spans
+
+    def integrate(self):
+
+        spans = self.spans()
+        tables = self.sim.transitions, self.node_table, self.sim.rotation_table
+
+        # Spread the bots over the workers, which must run in this process
+        # when it is already a worker of a parallel run
+        processes = min(self.processes, len(self.bots))
+        if multiprocessing.current_process().daemon:
+            processes = 1
+
+        states = [(b.name, b.get_state()) for b in self.bots]
+        tasks = [(states[i::processes], spans) for i in range(processes)]
+
+        if processes == 1:
+            init_worker(*tables)
+            results = [integrate_bots(task) for task in tasks]
+        else:
+            with multiprocessing.Pool(processes, init_worker, tables) as pool:
+                results = pool.map(integrate_bots, tasks)
+
+        tracks = [None] * len(self.bots)
+        for i, result in enumerate(results):
+            tracks[i::processes] = result
+
+        self.logger.info('Integrated %s bot moves from frame %s in %s processes',
+                         sum(len(t[0]) for t in tracks), self.start_frame, processes)
+
+        # Moves of all bots end to end, and the range of each bot's moves
+        self.frames, self.nodes, self.dirs, self.rots, self.floats = [
+            np.concatenate([t[column] for t in tracks]) for column in range(5)
+        ]
+        counts = np.array([len(t[0]) for t in tracks], dtype=np.int64)
+        self.ends = np.cumsum(counts)
+        self.offsets = self.ends - counts
+
+        # Index of the next move of each bot, and its frame
+        self.cursor = self.offsets.copy()
+        self.next_frame = np.array([
+            t[0][0] if len(t[0]) else self.NO_MOVE for t in tracks
+        ], dtype=np.int64)
+
+        self.integrated = True
+
+    def update(self, control_inputs):
+        """
+        Move every bot in a driven zone for this time step, which only advances
+        the frame until the bots are read.
+        """
+
+        if not self.integrated:
+            self.integrate()
+
+        self.frame = self.sim.frame + 1
+
+    @property
+    def node_ids(self):
+        self.sync()
+        return np.array([b.node_id for b in self.bots], dtype=np.int32)
+
+    def sync(self):
+        """
+        Bring each bot that moved since the last sync to its state after its last
+        move before the current frame.
+        """
+
+        if not self.integrated:
+            return
+
+        for i in np.nonzero(self.next_frame < self.frame)[0].tolist():
+
+            start, end = self.cursor[i], self.ends[i]
+            j = start + int(np.searchsorted(self.frames[start:end], self.frame))
+            k = j - 1
+
+            bot = self.bots[i]
+
+            last_node = self.nodes[k - 1] if k > self.offsets[i] else self.start_nodes[i]
+            bot.last_pos = self.node_table.mm[last_node]
+            bot.set_node(self.node_table.nodes[self.nodes[k]])
+            bot.rot = float(self.rots[k]) if self.floats[k] else int(self.rots[k])
+            bot.last_move_dir = int(self.dirs[k])
+
+            self.cursor[i] = j
+            self.next_frame[i] = self.frames[j] if j < end else self.NO_MOVE
@@ -0,0 +1,184 @@
+"""
+
+"""
+
+import logging
+
+from gridbots.core.routine import Command
+from gridbots.core.routine import SerialCommands
+from gridbots.core.routine import ParallelCommands
+
+
+class ScriptOptimizer():
+    """
+    Rewrites a parsed command tree into an equivalent one with fewer, larger
+    commands. Per-frame control inputs are unchanged, except that a fused wait
+    or zonewait reports the total wait time.
+
+    * Consecutive waits, and consecutive zonewaits on the same zone, are
+      coalesced into one
+    * Consecutive zmoves in the same zone and direction are fused
+    * Commands that produce no frames are dropped
+    * With inline_scripts, includes are spliced into their parent, which lets
+      the above apply across script boundaries at the cost of per-script
+      attribution
+
+    Folding happens only between siblings of the same serial block, so frames
+    keep their script stacks unless inline_scripts is set.
+
+    """
+
+    # Switch rate of the board
+    DEFAULT_RATE = 120  # Hz
+
+    def __init__(self, inline_scripts=False):
+
+        self.logger = logging.getLogger(__name__)
+
+        self.inline_scripts = inline_scripts
+
+        self.rate = self.DEFAULT_RATE
+
+        # Optimized serial blocks by (command, starting rate), so shared
+        # includes stay shared
+        self.optimized = {}
+
+    def optimize(self, command):
+
+        self.rate = self.DEFAULT_RATE
+        return self.optimize_command(command)
+
+    def optimize_command(self, command):
+
+        if isinstance(command, Command):
+            if command.name == 'rate':
+                self.rate = float(command.args[0])
+            return command
+
+        elif isinstance(command, SerialCommands):
+
+            key = (id(command), self.rate)
+            if key in self.optimized:
+                optimized, self.rate = self.optimized[key]
+                return optimized
+
+            optimized = SerialCommands(command.script)
+            self.fold(optimized, command)
+
+            self.optimized[key] = (optimized, self.rate)
+            return optimized
+
+        elif isinstance(command, ParallelCommands):
+
+            optimized = ParallelCommands(scripts=command.scripts)
+            for c in command:
+                optimized.append(self.optimize_command(c))
+
+            return optimized
+
+        else:
+            raise RuntimeError('Unknown command of type {}: {}'.format(
+                type(command), command
+            ))
+
+    def fold(self, commands, command):
+        """
+        Optimize the children of a serial block into the given one. Includes
+        are inlined child by child, so rate changes inside them apply to the
+        commands that follow in order.
+        """
+
+        for c in command:
+            if self.inline_scripts and isinstance(c, SerialCommands):
+                self.fold(commands, c)
+            else:
+                self.append(commands, self.optimize_command(c))
+
+    def append(self, commands, command):
+        """
+        Append a command to a serial block, folding it into the previous
+        command when possible.
+        """
+
+        if isinstance(command, Command):
+
+            if self.frames(command) == 0:
+                return
+
+            if commands and isinstance(commands[-1], Command):
+                fused = self.fuse(commands[-1], command)
+                if fused:
+                    commands[-1] = fused
+                    return
+
+        commands.append(command)
+
+    def frames(self, command):
+        """
+        Number of frames produced by a command, or None if not a wait or move.
+        """
+
+        if command.name == 'zmove':
+            zone, x, y = command.args
+            return abs(int(2 * float(x))) + abs(int(2 * float(y)))
+
+        elif command.name == 'wait':
+            return int(float(command.args[0]) * self.rate)
+
+        elif command.name == 'zonewait':
+            return int(float(command.args[1]) * self.rate)
+
+        return None
+
+    def fuse(self, c1, c2):
+        """
+        Return a single command equivalent to c1 followed by c2, or None.
+        """
+
+        if c1.name != c2.name:
+            return None
+
+        if c1.name == 'wait':
+            time = float(c1.args[0]) + float(c2.args[0])
+            fused = Command('wait', [repr(time)])
+
+        elif c1.name == 'zonewait':
+            if int(c1.args[0]) != int(c2.args[0]):
+                return None
+            time = float(c1.args[1]) + float(c2.args[1])
+            fused = Command('zonewait', [c1.args[0], repr(time)])
+
+        elif c1.name == 'zmove':
+            return self.fuse_zmoves(c1, c2)
+
+        else:
+            return None
+
+        # Rounding to whole frames must come out the same
+        if self.frames(fused) != self.frames(c1) + self.frames(c2):
+            return None
+
+        return fused
+
+    @staticmethod
+    def fuse_zmoves(c1, c2):
+
+        if int(c1.args[0]) != int(c2.args[0]):
+            return None
+
+        # Work in steps, each zmove runs its x steps then its y steps
+        x1, y1 = [int(2 * float(v)) for v in c1.args[1:]]
+        x2, y2 = [int(2 * float(v)) for v in c2.args[1:]]
+
+        def same_direction(a, b):
+            return a == 0 or b == 0 or (a > 0) == (b > 0)
+
+        if y1 == 0 and same_direction(x1, x2):
+            x, y = x1 + x2, y2
+        elif x2 == 0 and same_direction(y1, y2):
+            x, y = x1, y1 + y2
+        else:
+            return None
+
+        # Steps are half millimeters, so this round-trips exactly
+        return Command('zmove', [c1.args[0], repr(x / 2), repr(y / 2)])
@@ -0,0 +1,315 @@
+"""
+
+"""
+
+import os
+import shutil
+import logging
+import multiprocessing
+
+from gridbots.core.simulation import Simulation, STATES_PER_FILE, FRAMES_PER_STATE
+from gridbots.core.bot_tracks import BotTracks
+from gridbots.utils.simstate import SimulationState
+
+
+def simulate_segment(task):
+    """
+    Simulate one segment of a parallel run in a worker process, and return the
+    checkpoint data at its end, or None and the error if it failed.
+    """
+
+    sim_name, segment_dir, start_state, end_frame = task
+
+    # The parent has written the build script already, and rewriting it here
+    # could truncate it under a sibling worker that is reading it
+    sim = Simulation(sim_name, segment_dir=segment_dir, controller_options={'generate': False})
+
+    # A segment started from a wrong prediction can run into moves that are
+    # impossible from there, which only matters if the prediction was right
+    try:
+        return sim.run_segment(start_state, end_frame), None
+    except Exception as e:
+        return None, e
+
+
+class ParallelRun():
+    """
+    Simulates a build in segments on several processes at once. The routine is
+    split where boundary scripts finish. Every segment but the first starts
+    from the state predicted by the plan, which integrates the tracks of the
+    bots and steps the structure along the control inputs without recording
+    anything. The end state of each segment is then checked against the start
+    of the next, and segments that started from the wrong state run again from
+    the true one until the whole chain matches. Finally the states are stitched
+    into the same paths files as a serial run.
+
+    """
+
+    # Scripts after which a build is back in a known configuration, unless the
+    # simulation file lists its own boundary_scripts
+    DEFAULT_BOUNDARY_SCRIPTS = ['units1&2_buffer_advance', 'units1&2_tree_ready']
+
+    def __init__(self, sim, processes=None):
+
+        self.logger = logging.getLogger(__name__)
+
+        self.sim = sim
+        self.processes = processes or multiprocessing.cpu_count()
+
+        self.segments_dir = os.path.join(sim.paths_dir, 'segments')
+
+    def boundary_frames(self):
+        """
+        Frames at which a boundary script finishes.
+        """
+
+        names = self.sim.sim_data.get('boundary_scripts', self.DEFAULT_BOUNDARY_SCRIPTS)
+        names = [name if name.endswith('.txt') else name + '.txt' for name in names]
+
+        sites = self.sim.controller.builder.include_sites(names)
+        return sorted({start + frames for start, frames, _ in sites})
+
+    def plan(self, frames):
+        """
+        Step through the control inputs, which do not depend on the bots, and
+        return the number of frames in the routine along with the predicted
+        checkpoint data at the start of each of the given frames. A bot's moves
+        only depend on the control inputs too, so the bots are looked up in
+        their tracks, integrated on all processes up front, and the structure
+        is stepped along with them where it changes.
+        """
+
+        sim = self.sim
+        controller = sim.controller
+        structure = sim.structure
+        dt = 1 / sim.rate
+
+        tracks = BotTracks(sim, self.processes)
+        tracks.integrate()
+
+        def sync_bots(frame):
+            tracks.frame = frame
+            tracks.sync()
+
+        # An event log takes the script of every frame, recorded states only
+        # that of the recorded frames
+        every_frame = sim.output_format == 'events'
+
+        # The full state of a segment is that of the last recorded frame before
+        # it, taken at the start of the next frame
+        last_frames = {f: f - 1 - (f - 1) % FRAMES_PER_STATE for f in frames}
+        full_frames = {last_frame + 1 for last_frame in last_frames.values()}
+
+        frame = 0
+        time = 0
+        script_ids = {}
+        last_script = None, None
+        full_states = {}
+        starts = {}
+
+        wanted = set(frames)
+        while not controller.finished:
+
+            control_inputs, span = controller.step_span(frame)
+            script = control_inputs.get('script')
+
+            changes_structure = any(key in control_inputs for key in ('stagerel', 'feed', 'uv'))
+
+            for i in range(span):
+
+                if frame in full_frames and not every_frame:
+                    sync_bots(frame)
+                    s = SimulationState(frame - 1)
+                    s.set_bots(sim.bot_dict)
+                    s.set_structure(structure)
+                    if last_script[0] is not None:
+                        s.set_scripts(*last_script)
+                    full_states[frame] = s.serialize()
+
+                if frame in wanted:
+                    sync_bots(frame)
+                    starts[frame] = dict(
+                        frame=frame,
+                        time=time,
+                        bots={b.name: b.get_state() for b in sim.bots},
+                        structure=structure.get_state(),
+                        full_state=full_states.get(last_frames[frame] + 1),
+                        event_script=last_script[0] if every_frame else None,
+                        num_scripts=len(script_ids)
+                    )
+
+                if (every_frame or frame % FRAMES_PER_STATE == 0) and script is not None:
+                    script_ids.setdefault(script, len(script_ids))
+                    last_script = script_ids[script], time
+
+                # The structure reads the bots after the moves of the frame
+                if changes_structure or structure.pending_rods:
+                    sync_bots(frame + 1)
+                    sim.frame = frame
+                    structure.update(control_inputs)
+
+                time += dt
+                frame += 1
+
+        scripts = sorted(script_ids, key=script_ids.get)
+
+        return frame, scripts, starts
+
+    @staticmethod
+    def predict(initial, scripts, start):
+        """
+        Return the checkpoint data at the start of a segment, from what the
+        plan predicted for it.
+        """
+
+        start = dict(start)
+        num_scripts = start.pop('num_scripts')
+
+        return dict(
+            initial,
+            new_file_frame=start['frame'],
+            states={},
+            script_stacks=scripts[:num_scripts],
+            **start
+        )
+
+    @staticmethod
+    def bot_state(state):
+        """
+        The parts of a bot's checkpoint state that later frames depend on. The
+        position before its last move is left out, since nothing reads it and
+        each engine keeps it differently.
+        """
+
+        node, rot, last_move_dir, last_pos = state
+        return node, rot, isinstance(rot, float), last_move_dir
+
+    @classmethod
+    def matches(cls, end, start):
+        """
+        Whether a segment ended in the state that the next one started from.
+        """
+
+        for key in ('frame', 'time', 'structure', 'script_stacks', 'event_script'):
+            if end[key] != start[key]:
+                return False
+
+        for name, state in end['bots'].items():
+            if cls.bot_state(state) != cls.bot_state(start['bots'][name]):
+                return False
+
+        if end['full_state'] is None or start['full_state'] is None:
+            return end['full_state'] == start['full_state']
+
+        return (
+            SimulationState.deserialize(end['full_state']).__dict__ ==
+            SimulationState.deserialize(start['full_state']).__dict__
+        )
+
+    def segment_dir(self, i):
+        return os.path.join(self.segments_dir, str(i))
+
+    def run(self):
+
+        sim = self.sim
+        if sim.resume_frame != 0 or sim.stats_only:
+            raise Exception('Parallel runs write all paths from the start')
+
+        initial = sim.checkpoint_data()
+
+        boundaries = self.boundary_frames()
+        num_frames, scripts, starts = self.plan(boundaries)
+
+        # Split at the boundaries closest to equal lengths
+        boundaries = [f for f in boundaries if 0 < f < num_frames]
+        split_frames = sorted({
+            min(boundaries, key=lambda f: abs(f - num_frames * i // self.processes))
+            for i in range(1, self.processes)
+        }) if boundaries else []
+
+        self.logger.info('Simulating %s in %s segments, split at frames %s',
+                         sim.sim_name, len(split_frames) + 1, split_frames)
+
+        # The plan steps the bots and structure, so put them back at the start
+        sim.restore_checkpoint(initial)
+
+        start_states = [initial] + [self.predict(initial, scripts, starts[f]) for f in split_frames]
+        end_frames = split_frames + [None]
+        end_states = [None] * len(start_states)
+        errors = [None] * len(start_states)
+
+        pending = list(range(len(start_states)))
+        rounds = 0
+        with multiprocessing.Pool(self.processes) as pool:
+            while pending:
+
+                rounds += 1
+                self.logger.info('Round %s, simulating segments %s', rounds, pending)
+
+                tasks = [(sim.sim_name, self.segment_dir(i), start_states[i], end_frames[i]) for i in pending]
+                for i, (end_state, error) in zip(pending, pool.map(simulate_segment, tasks)):
+                    end_states[i] = end_state
+                    errors[i] = error
+
+                # Run segments again from where the previous one really ended.
+                # The first mismatch always follows a correct chain, so each
+                # round settles at least one more segment. A segment that
+                # failed after a correct chain started from its true state.
+                pending = []
+                for i in range(len(start_states)):
+                    if i > 0 and end_states[i - 1] and not self.matches(end_states[i - 1], start_states[i]):
+                        start_states[i] = dict(
+                            end_states[i - 1],
+                            new_file_frame=split_frames[i - 1],
+                            states={},
+                            script_profile={}
+                        )
+                        pending.append(i)
+                    elif end_states[i] is None and not pending:
+                        raise errors[i]
+
+        self.logger.info('All segments match after %s rounds', rounds)
+
+        self.stitch(len(start_states))
+
+        # Frames and time spent in each script, summed over the segments
+        profile = {}
+        for end_state in end_states:
+            for script, (frames, seconds) in end_state['script_profile'].items():
+                totals = profile.setdefault(script, [0, 0.0])
+                totals[0] += frames
+                totals[1] += seconds
+
+        sim.restore_checkpoint(dict(end_states[-1], script_profile=profile))
+        sim.dump_meta()
+        sim.dump_profile()
+
+        shutil.rmtree(self.segments_dir)
+
+        return sim.sim_name
+
+    def stitch(self, num_segments):
+        """
+        Write the states of all segments into paths files, split where a serial
+        run would split them.
+        """
+
+        sim = self.sim
+
+        sim.new_file_frame = 0
+        sim.states = {}
+
+        for i in range(num_segments):
+
+            segment_dir = self.segment_dir(i)
+
+            for file_frame in sim.paths_file_frames(segment_dir):
+                states = sim.load_paths(file_frame, segment_dir)
+
+                for frame, state in sorted(states.items()):
+                    sim.states[frame] = state
+                    if len(sim.states) >= STATES_PER_FILE:
+                        sim.frame = frame
+                        sim.dump_data()
+
+        sim.dump_data()
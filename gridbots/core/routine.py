@@ -4,12 +4,16 @@
 
 import os
 import re
+import heapq
+import hashlib
 import logging
+from bisect import bisect_right
 from pprint import pformat
 
 logging.basicConfig(format='%(message)s', level=logging.DEBUG)
 
 import gridbots
+from gridbots.utils.script_cache import script_cache
 
 
 class Command():
@@ -45,6 +49,113 @@ class SerialCommands(list):
         return '\nS({})'.format(self.script) + list.__repr__(self)
 
 
+class Trajectory():
+    """
+    Run-length encoded sequence of control inputs. Each segment is either a
+    control input dict applied for a number of consecutive frames, or a nested
+    Trajectory. Nested trajectories are shared by reference, so a sub-script
+    expanded once can be used from every place it is included (a rope). Memory
+    scales with the number of distinct script commands rather than simulated
+    frames.
+
+    """
+
+    def __init__(self):
+
+        # Control input or nested Trajectory of each segment
+        self.inputs = []
+
+        # Cumulative frame count at the end of each segment
+        self.ends = []
+
+    def __len__(self):
+        return self.ends[-1] if self.ends else 0
+
+    def __getitem__(self, frame):
+        """
+        Return the control input for the given frame, by binary search on the
+        segment boundaries of each level of nesting.
+        """
+
+        if frame < 0 or frame >= len(self):
+            raise IndexError('Frame {} out of range'.format(frame))
+
+        trajectory = self
+        while True:
+            i = bisect_right(trajectory.ends, frame)
+            node = trajectory.inputs[i]
+            if not isinstance(node, Trajectory):
+                return node
+            if i > 0:
+                frame -= trajectory.ends[i - 1]
+            trajectory = node
+
+    def span(self, frame):
+        """
+        Return the control input for the given frame, and the number of frames
+        from it to the end of its segment.
+        """
+
+        if frame < 0 or frame >= len(self):
+            raise IndexError('Frame {} out of range'.format(frame))
+
+        trajectory = self
+        while True:
+            i = bisect_right(trajectory.ends, frame)
+            node = trajectory.inputs[i]
+            if not isinstance(node, Trajectory):
+                return node, trajectory.ends[i] - frame
+            if i > 0:
+                frame -= trajectory.ends[i - 1]
+            trajectory = node
+
+    def __iter__(self):
+        for control_input, count in self.segments():
+            for i in range(count):
+                yield control_input
+
+    def __repr__(self):
+        return 'Trajectory(segments={}, frames={})'.format(len(self.inputs), len(self))
+
+    def segments(self):
+        """
+        Yield (control input, frame count) pairs in order, flattening nested
+        trajectories.
+        """
+
+        start = 0
+        for node, end in zip(self.inputs, self.ends):
+            if isinstance(node, Trajectory):
+                yield from node.segments()
+            else:
+                yield node, end - start
+            start = end
+
+    def append(self, control_input, count=1):
+
+        if count <= 0:
+            return
+
+        self.inputs.append(control_input)
+        self.ends.append(len(self) + count)
+
+    def append_trajectory(self, trajectory):
+        """
+        Append a trajectory by reference, without copying its segments.
+        """
+
+        if len(trajectory) == 0:
+            return
+
+        self.inputs.append(trajectory)
+        self.ends.append(len(self) + len(trajectory))
+
+    def extend(self, trajectory):
+
+        for control_input, count in trajectory.segments():
+            self.append(control_input, count)
+
+
 class TrajectoryBuilder():
 
     SCRIPT_DIR = os.path.join(gridbots.path, 'sri-scripts')
@@ -52,76 +163,300 @@ class TrajectoryBuilder():
     # Switch rate of the board
     DEFAULT_RATE = 120  # Hz
 
-    def __init__(self, path, script_name):
+    def __init__(self, path, script_name, lazy=False, cache=script_cache,
+                 optimize=False, inline_scripts=False):
 
         self.rate = self.DEFAULT_RATE
 
         self.script = []
 
-        self.commands = self.process_script(script_name)
-        logging.debug('Commands:\n%s\n', self.commands)
+        self.script_name = script_name
+        self.lazy = lazy
+        self.optimize = optimize
+        self.inline_scripts = inline_scripts
+
+        # Cache of parsed command trees, or None to always parse
+        self.cache = cache
+
+        # Expanded trajectory and end rate of each serial command block, by
+        # (command, starting rate, script stack)
+        self.expanded = {}
+
+        # Intern table of script stacks, so frames share one immutable tuple
+        self.script_stacks = {}
 
-        self.moves = self.generate_trajectory(self.commands)
+        self.load()
+
+        # In lazy mode, moves are generated on demand by iter_moves
+        self.moves = None
+        if not lazy:
+            self.moves = self.generate_trajectory(self.commands)
         # logging.debug('Zone moves:\n%s\n', pformat(self.moves))
 
+    def load(self):
+        """
+        Read the command tree of the top-level script and the include graph of
+        everything it calls.
+        """
+
+        # Lines and digest of each script read so far
+        self.script_lines = {}
+        self.script_digests = {}
+
+        # Stack of dependency digests for the scripts being parsed
+        self.deps = [{}]
+
+        self.commands = self.process_script(self.script_name)
+        logging.debug('Commands:\n%s\n', self.commands)
+
+        # Digests of the top-level script and everything it includes
+        self.dependencies = self.deps.pop()
+
+        # Map of each script to the scripts it includes directly
+        self.includes = self.include_graph(self.commands)
+
+        if self.cache:
+            self.cache.save()
+
+        # Fold the command tree into fewer, larger commands
+        if self.optimize or self.inline_scripts:
+            from gridbots.core.optimizer import ScriptOptimizer
+            optimizer = ScriptOptimizer(inline_scripts=self.inline_scripts)
+            self.commands = optimizer.optimize(self.commands)
+            logging.debug('Optimized commands:\n%s\n', self.commands)
+
+    def changed_scripts(self, dependencies):
+        """
+        Return the scripts whose digest differs from the given dependency
+        digests, such as those of a previous run.
+        """
+
+        return {
+            name for name, digest in self.dependencies.items()
+            if dependencies.get(name) != digest
+        }
+
+    def include_graph(self, command):
+        """
+        Return a map of each script in the command tree to the scripts it
+        includes directly, either with < lines or as simscript arguments.
+        """
+
+        graph = {}
+
+        def visit(command, parent, name):
+
+            if isinstance(command, Command):
+                return
+
+            # Blocks that are not script files belong to the enclosing script
+            if name in self.dependencies:
+                if parent is not None and name not in graph[parent]:
+                    graph[parent].append(name)
+                if name in graph:
+                    return
+                graph[name] = []
+                parent = name
+
+            for c, c_name in self.named_children(command):
+                visit(c, parent, c_name)
+
+        visit(command, None, self.script_name)
+        return graph
+
+    @staticmethod
+    def named_children(command):
+        """
+        Yield each child of a command block with the name of the script it
+        runs, or ''. Scripts run by a simscript are copied into unnamed blocks,
+        which are matched up with the names listed on the parallel block.
+        """
+
+        if isinstance(command, ParallelCommands):
+            scripts = iter(command.scripts)
+            for c in command:
+                if isinstance(c, SerialCommands):
+                    yield c, next(scripts, '')
+                else:
+                    yield c, ''
+        else:
+            for c in command:
+                yield c, c.script if isinstance(c, SerialCommands) else ''
+
+    def including_scripts(self, scripts):
+        """
+        Return every script that calls one of the given scripts, directly or
+        through other scripts.
+        """
+
+        callers = {}
+        for name, included in self.includes.items():
+            for i in included:
+                callers.setdefault(i, []).append(name)
+
+        found = set()
+        pending = list(scripts)
+        while pending:
+            for caller in callers.get(pending.pop(), []):
+                if caller not in found:
+                    found.add(caller)
+                    pending.append(caller)
+
+        return found
+
+    def include_sites(self, scripts, command=None):
+        """
+        Return a sorted list of (start frame, frame count, script) for every
+        place one of the given scripts runs in the routine. Frame counts come
+        from the estimator, and only the subtrees that include one of the
+        scripts are walked.
+        """
+
+        if command is None:
+            command = self.commands
+
+        scripts = set(scripts)
+        callers = self.including_scripts(scripts)
+        memo = {}
+        sites = []
+
+        def visit(command, frame, rate, name):
+
+            frames, seconds, _, end_rate = self.estimate_command(command, rate, memo)
+
+            if isinstance(command, Command):
+                return frames, end_rate
+
+            if name in self.dependencies:
+                if name in scripts:
+                    sites.append((frame, frames, name))
+                if name not in callers:
+                    return frames, end_rate
+
+            if isinstance(command, SerialCommands):
+                start = frame
+                for c, c_name in self.named_children(command):
+                    c_frames, rate = visit(c, frame, rate, c_name)
+                    frame += c_frames
+                return frame - start, rate
+
+            # Parallel children all start together
+            for c, c_name in self.named_children(command):
+                c_frames, rate = visit(c, frame, rate, c_name)
+            return frames, rate
+
+        rate = self.rate
+        visit(command, 0, self.DEFAULT_RATE, getattr(command, 'script', ''))
+        self.rate = rate
+
+        return sorted(sites)
+
+    def first_frame(self, scripts):
+        """
+        Return the first frame at which any of the given scripts runs, or None
+        if they are not part of the routine. The top-level script starts at
+        frame 0.
+        """
+
+        if self.script_name in scripts:
+            return 0
+
+        sites = self.include_sites(scripts)
+        if sites:
+            return sites[0][0]
+
+        # Inlined scripts leave no blocks to find, so assume the worst
+        if any(name in self.dependencies for name in scripts):
+            return 0
+
+        return None
+
+    def command_segments(self, command, script):
+        """
+        Return the (control input, frame count) segments of a single command,
+        tagged with the given script stack.
+        """
+
+        if command.name == 'zmove':
+            zone, x, y = command.args
+            return self.zmove_to_segments(zone, float(x), float(y), script)
+
+        elif command.name == 'rate':
+            rate, = command.args
+            self.rate = float(rate)
+            return [({'rate': self.rate, 'script': script}, 1)]
+
+        elif command.name == 'zonewait':
+            zone, time = command.args
+            time = float(time)
+            frames = int(time * self.rate)
+            return [({
+                'zonewaiting_Z{}'.format(zone): time,
+                'script': script
+            }, frames)]
+
+        elif command.name == 'wait':
+            time, = command.args
+            time = float(time)
+            frames = int(time * self.rate)
+            return [({'waiting': time, 'script': script}, frames)]
+
+        elif command.name == 'uv':
+            state, = command.args
+            state = int(state)
+            return [({'uv': state, 'script': script}, 1)]
+
+        elif command.name == 'feed':
+            feed_type, = command.args
+            return [({'feed': feed_type, 'script': script}, 1)]
+
+        elif command.name == 'stagerel':
+            x, y, z = [float(v) for v in command.args]
+            return [({'stagerel': [x, y, z], 'script': script}, 1)]
+
+        else:
+            logging.warning('Unknown command %s', command)
+            return [({command.name: command.args, 'script': script}, 1)]
+
     def generate_trajectory(self, command):
 
+        trajectory = Trajectory()
+
         if isinstance(command, Command):
 
-            if command.name == 'zmove':
-                zone, x, y = command.args
-                return self.zmove_to_trajectory(zone, float(x), float(y))
-
-            elif command.name == 'rate':
-                rate, = command.args
-                self.rate = float(rate)
-                return [{'rate': self.rate, 'script': list(self.script)}]
-
-            elif command.name == 'zonewait':
-                zone, time = command.args
-                time = float(time)
-                frames = int(time * self.rate)
-                return [{
-                    'zonewaiting_Z{}'.format(zone): time,
-                    'script': list(self.script)
-                } for i in range(frames)]
-
-            elif command.name == 'wait':
-                time, = command.args
-                time = float(time)
-                frames = int(time * self.rate)
-                return [{'waiting': time, 'script': list(self.script)} for i in range(frames)]
-
-            elif command.name == 'uv':
-                state, = command.args
-                state = int(state)
-                return [{'uv': state, 'script': list(self.script)}]
-
-            elif command.name == 'feed':
-                feed_type, = command.args
-                return [{'feed': feed_type, 'script': list(self.script)}]
-
-            elif command.name == 'stagerel':
-                x, y, z = [float(v) for v in command.args]
-                return [{'stagerel': [x, y, z], 'script': list(self.script)}]
+            script = self.intern_script(self.script_key())
+            for control_input, count in self.command_segments(command, script):
+                trajectory.append(control_input, count)
 
-            else:
-                logging.warning('Unknown command %s', command)
-                return [{command.name: command.args, 'script': list(self.script)}]
+            return trajectory
 
         elif isinstance(command, SerialCommands):
 
+            # Reuse the expansion of an identical include, which is the same
+            # command tree at the same rate with the same callers
+            # Entries hold on to their command, so that an id cannot be reused
+            # by another command
+            key = (id(command), self.rate, self.script_key())
+            cached = self.expanded.get(key)
+            if cached and cached[0] is command:
+                trajectory, self.rate = cached[1:]
+                return trajectory
+
             # Create a trajectory for each sub-command
             self.script.append(command.script)
             trajectories = [self.generate_trajectory(c) for c in command]
 
             self.script.pop()
 
-            # Concatenate all moves together in order
-            #serial_trajectory = [move for trajectory in trajectories for move in trajectory]
-            serial_trajectory = [move for trajectory in trajectories for move in trajectory]
+            # Concatenate in order, sharing the trajectories of nested blocks
+            for c, sub_trajectory in zip(command, trajectories):
+                if isinstance(c, SerialCommands):
+                    trajectory.append_trajectory(sub_trajectory)
+                else:
+                    trajectory.extend(sub_trajectory)
 
-            return serial_trajectory
+            self.expanded[key] = (command, trajectory, self.rate)
+            return trajectory
 
         elif isinstance(command, ParallelCommands):
 
@@ -130,23 +465,235 @@ class TrajectoryBuilder():
             trajectories = [self.generate_trajectory(c) for c in command]
             self.script.pop()
 
-            # Merge moves from each sub-command together
-            parallel_trajectory = []
-            for trajectory in trajectories:
-                for i in range(len(trajectory)):
-                    try:
-                        parallel_trajectory[i].update(trajectory[i])
-                    except IndexError:
-                        parallel_trajectory.append(trajectory[i])
+            # Merge the segments of each sub-command together
+            for control_input, count in self.merge_segments([t.segments() for t in trajectories]):
+                trajectory.append(control_input, count)
 
-            return parallel_trajectory
+            return trajectory
 
         else:
             raise RuntimeError('Unknown command of type {}: {}'.format(
                 type(command), command
             ))
 
-    def zmove_to_trajectory(self, zone, x, y):
+    def script_key(self):
+        """
+        Hashable form of the current script stack.
+        """
+        return tuple(tuple(s) if isinstance(s, list) else s for s in self.script)
+
+    def intern_script(self, script):
+        """
+        Return the shared instance of the given script stack tuple.
+        """
+        return self.script_stacks.setdefault(script, script)
+
+    def iter_segments(self, command, script=()):
+        """
+        Lazily walk the command tree, yielding (control input, frame count)
+        segments in order. Only one path through the tree is held at a time,
+        so memory is bounded by the script nesting depth.
+        """
+
+        if isinstance(command, Command):
+
+            for segment in self.command_segments(command, self.intern_script(script)):
+                if segment[1] > 0:
+                    yield segment
+
+        elif isinstance(command, SerialCommands):
+
+            script = script + (command.script,)
+            for c in command:
+                yield from self.iter_segments(c, script)
+
+        elif isinstance(command, ParallelCommands):
+
+            script = script + (tuple(command.scripts),)
+            segments = [self.iter_segments(c, script) for c in command]
+            yield from self.merge_segments(segments)
+
+        else:
+            raise RuntimeError('Unknown command of type {}: {}'.format(
+                type(command), command
+            ))
+
+    def iter_moves(self, command=None, script=()):
+        """
+        Lazily yield the control input of each frame. Defaults to the whole
+        routine.
+        """
+
+        if command is None:
+            command = self.commands
+
+        for control_input, count in self.iter_segments(command, script):
+            for i in range(count):
+                yield control_input
+
+    @staticmethod
+    def merge_segments(children):
+        """
+        K-way merge of segment iterators that run side by side. Yields merged
+        (control input, frame count) segments, splitting at every boundary of
+        any child. Later children take precedence on shared keys, except that
+        two children driving the same zone in different directions is an
+        error.
+        """
+
+        children = [iter(c) for c in children]
+
+        # Current control input of each child, and a heap of (end frame, child)
+        current = [None] * len(children)
+        heap = []
+        frame = 0
+
+        def advance(i):
+            for control_input, count in children[i]:
+                if count > 0:
+                    current[i] = control_input
+                    heapq.heappush(heap, (frame + count, i))
+                    return
+            current[i] = None
+
+        for i in range(len(children)):
+            advance(i)
+
+        pending, pending_count = None, 0
+
+        while heap:
+
+            # Only one child left, pass its segments through unchanged
+            if len(heap) == 1:
+                end, i = heap[0]
+                if pending_count:
+                    yield pending, pending_count
+                yield current[i], end - frame
+                for segment in children[i]:
+                    if segment[1] > 0:
+                        yield segment
+                return
+
+            end = heap[0][0]
+
+            merged = {}
+            for control_input in current:
+                if control_input is None:
+                    continue
+                for key, value in control_input.items():
+                    if key[0] == 'Z' and merged.get(key, value) != value:
+                        raise RuntimeError('Conflicting moves for zone {} in parallel scripts: {} and {}'.format(
+                            key, merged[key], value
+                        ))
+                merged.update(control_input)
+
+            # Join with the previous span if the merged inputs are the same
+            if pending_count and merged == pending:
+                pending_count += end - frame
+            else:
+                if pending_count:
+                    yield pending, pending_count
+                pending, pending_count = merged, end - frame
+
+            frame = end
+            while heap and heap[0][0] == end:
+                end, i = heapq.heappop(heap)
+                advance(i)
+
+        if pending_count:
+            yield pending, pending_count
+
+    def estimate(self, command=None):
+        """
+        Compute the length of a routine from its command tree, without
+        generating any per-frame data. Defaults to the whole routine.
+
+        Returns a dict with the total number of frames and seconds, and a
+        breakdown of frames, seconds and calls for each script. Script totals
+        are inclusive of the scripts they call.
+        """
+
+        if command is None:
+            command = self.commands
+
+        # Estimating steps the rate like expansion does, so put it back for
+        # a lazy expansion in progress
+        rate = self.rate
+        frames, seconds, scripts, end_rate = self.estimate_command(command, self.DEFAULT_RATE, {})
+        self.rate = rate
+
+        return {
+            'frames': frames,
+            'time': seconds,
+            'scripts': {name: dict(data) for name, data in scripts.items()}
+        }
+
+    def estimate_command(self, command, rate, memo):
+        """
+        Return (frames, seconds, script breakdown, end rate) of a command
+        starting at the given rate. Results for serial blocks are memoized by
+        (command, rate), since the same scripts are included many times.
+        """
+
+        if isinstance(command, Command):
+
+            # Use the same expansion rules as the trajectory, but only keep
+            # the segment counts
+            self.rate = rate
+            segments = self.command_segments(command, None)
+            frames = sum(count for control_input, count in segments)
+
+            return frames, frames / self.rate, {}, self.rate
+
+        elif isinstance(command, SerialCommands):
+
+            key = (id(command), rate)
+            if key in memo:
+                return memo[key]
+
+            frames, seconds, scripts = 0, 0.0, {}
+            for c in command:
+                c_frames, c_seconds, c_scripts, rate = self.estimate_command(c, rate, memo)
+                frames += c_frames
+                seconds += c_seconds
+                self.add_script_estimates(scripts, c_scripts)
+
+            if command.script:
+                self.add_script_estimates(scripts, {
+                    command.script: {'frames': frames, 'time': seconds, 'calls': 1}
+                })
+
+            memo[key] = (frames, seconds, scripts, rate)
+            return memo[key]
+
+        elif isinstance(command, ParallelCommands):
+
+            # Children run side by side, so the block lasts as long as the
+            # longest one
+            frames, seconds, scripts = 0, 0.0, {}
+            for c in command:
+                c_frames, c_seconds, c_scripts, rate = self.estimate_command(c, rate, memo)
+                frames = max(frames, c_frames)
+                seconds = max(seconds, c_seconds)
+                self.add_script_estimates(scripts, c_scripts)
+
+            return frames, seconds, scripts, rate
+
+        else:
+            raise RuntimeError('Unknown command of type {}: {}'.format(
+                type(command), command
+            ))
+
+    @staticmethod
+    def add_script_estimates(totals, scripts):
+
+        for name, data in scripts.items():
+            if name not in totals:
+                totals[name] = {'frames': 0, 'time': 0.0, 'calls': 0}
+            for k, v in data.items():
+                totals[name][k] += v
+
+    def zmove_to_segments(self, zone, x, y, script):
 
         # 0.5 mm converts to one edge
         x = int(2 * x)
@@ -154,17 +701,17 @@ class TrajectoryBuilder():
 
         zone_name = 'Z{:02}'.format(int(zone))
 
-        trajectory = []
+        segments = []
 
-        x_move = '+X' if x > 0 else '-X'
-        for i in range(abs(x)):
-            trajectory.append({zone_name: x_move, 'script': list(self.script)})
+        if x != 0:
+            x_move = '+X' if x > 0 else '-X'
+            segments.append(({zone_name: x_move, 'script': script}, abs(x)))
 
-        y_move = '+Y' if y > 0 else '-Y'
-        for i in range(abs(y)):
-            trajectory.append({zone_name: y_move, 'script': list(self.script)})
+        if y != 0:
+            y_move = '+Y' if y > 0 else '-Y'
+            segments.append(({zone_name: y_move, 'script': script}, abs(y)))
 
-        return trajectory
+        return segments
 
     def read_script(self, script_name):
 
@@ -186,19 +733,51 @@ class TrajectoryBuilder():
 
         return lines
 
+    def script_digest(self, script_name):
+        """
+        Return a digest of the commands in the given script, ignoring comments
+        and blank lines.
+        """
+
+        if script_name not in self.script_digests:
+            lines = self.read_script(script_name)
+            self.script_lines[script_name] = lines
+            self.script_digests[script_name] = hashlib.sha1(
+                '\n'.join(lines).encode('utf-8')
+            ).hexdigest()
+
+        return self.script_digests[script_name]
+
     def process_script(self, script_name):
 
         try:
-            lines = self.read_script(script_name)
+            digest = self.script_digest(script_name)
         except FileNotFoundError:
             logging.error('Script not found: %s', script_name)
             raise
 
-        commands = SerialCommands(script=script_name)
-        for i, line in enumerate(lines):
-            logging.debug('Script %s, Line %s: %s', script_name, i+1, line)
-            command = self.process_script_line(line)
-            commands.append(command)
+        cached = self.cache.get(script_name, self.script_digest) if self.cache else None
+
+        if cached:
+            deps, commands = cached
+            logging.debug('Script %s: using cached commands', script_name)
+
+        else:
+            self.deps.append({script_name: digest})
+
+            commands = SerialCommands(script=script_name)
+            for i, line in enumerate(self.script_lines[script_name]):
+                logging.debug('Script %s, Line %s: %s', script_name, i+1, line)
+                command = self.process_script_line(line)
+                commands.append(command)
+
+            deps = self.deps.pop()
+            if self.cache:
+                self.cache.put(script_name, deps, commands)
+
+        # The including script depends on everything this one does
+        self.deps[-1].update(deps)
+
         return commands
 
     def process_script_line(self, line):
@@ -270,10 +849,11 @@ class TrajectoryBuilder():
         parallel = ParallelCommands(scripts=[])
         for line in lines:
             command = self.process_script_line(line)
-            parallel.append(command)
             if isinstance(command, SerialCommands):
                 parallel.scripts.append(command.script)
-                command.script = ''
+                # Wrap rather than rename, since parsed scripts may be shared
+                command = SerialCommands('', command)
+            parallel.append(command)
             #     parallel.extend(command)
             # elif isinstance(command, Command):
             #     parallel.append(command)
@@ -296,6 +876,9 @@ if __name__ == '__main__':
     else:
         top_level_script = sys.argv[1]
 
-    builder = TrajectoryBuilder(top_level_script)
-
-    print(yaml.dump(builder.moves))
+    if len(sys.argv) > 2 and sys.argv[2] == 'estimate':
+        builder = TrajectoryBuilder(TrajectoryBuilder.SCRIPT_DIR, top_level_script, lazy=True)
+        print(yaml.dump(builder.estimate(), default_flow_style=False))
+    else:
+        builder = TrajectoryBuilder(TrajectoryBuilder.SCRIPT_DIR, top_level_script)
+        print(yaml.dump(list(builder.moves.segments())))
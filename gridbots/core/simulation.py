@@ -11,13 +11,23 @@ import networkx as nx
 import pickle
 import shutil
 
+import numpy as np
+
 import gridbots
 from gridbots import utils
-from gridbots.core.bot import Bot
+from gridbots.utils.maputils import NodeTable, transition_table
+from gridbots.core.bot import RotationTable
+from gridbots.core.bot_array import BotArray
+from gridbots.core.bot_tracks import BotTracks
 from gridbots.core.structure import Structure
 from gridbots.controllers.single_routine import RoutineController
 from gridbots.controllers.lattice_builder import LatticeController
 from gridbots.utils.simstate import SimulationState
+from gridbots.utils.columns import state_row, apply_rods, write_chunk, chunk_rows, chunk_end_rods
+from gridbots.utils.events import write_events, read_events
+from gridbots.utils.paths_index import PathsIndex
+from gridbots.utils.compression import check_codec, compress, decompress, extension, split_extension
+from gridbots.utils.stats import get_accumulator
 
 STATES_PER_FILE = 10000
 FRAMES_PER_STATE = 6
@@ -41,11 +51,42 @@ class Simulation:
     # Default framerate of the system
     DEFAULT_RATE = 120
 
-    def __init__(self, sim_name):
+    # Accumulators of a stats-only run, unless the simulation file lists them
+    DEFAULT_STATS = ['script_time', 'bot_travel', 'rod_detach']
+
+    # Recorded states from one complete keyframe state to the next, unless the
+    # simulation file gives a keyframe_interval
+    DEFAULT_KEYFRAME_INTERVAL = 100
+
+    # Codec of the paths files, unless the simulation file gives a compression
+    DEFAULT_COMPRESSION = 'zlib'
+
+    # Frames from one checkpoint to the next within a paths file, unless the
+    # simulation file gives a checkpoint_interval
+    DEFAULT_CHECKPOINT_INTERVAL = 6000
+
+    def __init__(self, sim_name, incremental=False, stats_only=False, resume=False, start_frame=None,
+                 segment_dir=None, controller_options=None):
         """
         Read in all simulation data from the given file and linked files. This includes
         the map graph, the target structure graph, bots, stations, and job types.
 
+        If incremental, the paths of a previous run are kept up to the first frame
+        affected by any script edited since then, and simulation resumes there.
+
+        If stats_only, no states are recorded. The accumulators listed under stats
+        in the simulation file run instead, and their results are written to
+        spec/stats along with the metadata.
+
+        If resume, simulation continues from the latest checkpoint of a previous run,
+        or the latest one at or before start_frame if given.
+
+        If segment_dir is given, the simulation runs one segment of a parallel run,
+        with run_segment, and writes its states there instead of to spec/paths.
+
+        If controller_options is given, they override the controller options in the
+        simulation file.
+
         """
 
         self.logger = logging.getLogger(__name__)
@@ -65,14 +106,46 @@ class Simulation:
         map_path = os.path.join(gridbots.path, 'spec', 'maps', '{}.gpickle'.format(self.map_name))
         self.map = nx.read_gpickle(map_path)
 
+        # Next node of each zone move, checked for ambiguous moves
+        self.transitions = transition_table(self.map)
+
+        # Coordinates of each node
+        self.node_table = NodeTable(self.map)
+
+        # Direction of each move and change in rotation between directions
+        self.rotation_table = RotationTable(self.node_table, self.transitions)
+
         # Iterate through the input file and create bots
         self.bots = utils.parse.parse_bots(
             self.sim_data['bots'],
             self.node_aliases,
-            self.map
+            self.map,
+            self.transitions,
+            self.node_table,
+            self.rotation_table
         )
         self.bot_dict = {b.name: b for b in self.bots}
 
+        # Either update Bot objects one by one, step all bots at once with a
+        # NumPy array of their state, or integrate each bot's track up front
+        self.engine = self.sim_data.get('engine', 'bots')
+        if self.engine not in ('bots', 'numpy', 'tracks'):
+            raise Exception('Unknown engine: {}'.format(self.engine))
+
+        # Paths are written as pickled states, as chunks of NumPy arrays, or as
+        # a log of every change
+        self.output_format = self.sim_data.get('output_format', 'pickle')
+        if self.output_format not in ('pickle', 'columns', 'events'):
+            raise Exception('Unknown output format: {}'.format(self.output_format))
+
+        # Recorded states between keyframes, which hold the complete state so
+        # that playback can seek without replaying from the start, or 0 for none
+        self.keyframe_interval = self.sim_data.get('keyframe_interval', self.DEFAULT_KEYFRAME_INTERVAL)
+
+        # Codec that paths files are compressed with
+        self.compression = self.sim_data.get('compression', self.DEFAULT_COMPRESSION)
+        check_codec(self.compression)
+
         # Create a structure object
         self.structure = Structure(self)
 
@@ -85,7 +158,8 @@ class Simulation:
         else:
             raise Exception('Unknown controller type: {}'.format(controller_type))
 
-        self.controller = controller_class(self, self.sim_data['controller']['options'])
+        controller_options = dict(self.sim_data['controller']['options'], **(controller_options or {}))
+        self.controller = controller_class(self, controller_options)
 
         # Count frames
         self.frame = 0
@@ -93,6 +167,11 @@ class Simulation:
         # Simulation time
         self.time = 0
 
+        # Frame the simulation stops at, if not the end of the routine
+        self.end_frame = None
+
+        self.index_bots()
+
         # Simulation status
         self.status = self.STATUS["in_progress"]
 
@@ -101,17 +180,58 @@ class Simulation:
         # Current system rate
         self.rate = self.DEFAULT_RATE
 
+        # Skip through spans of frames in which nothing moves
+        self.fast_forward = self.sim_data.get('fast_forward', False)
+
+        # Frame that skipped spans must not run past, if any
+        self.stop_frame = None
+
         # Create the paths directory if needed
         top_paths_dir = os.path.join(gridbots.path, 'spec', 'paths')
         if not os.path.exists(top_paths_dir):
             os.makedirs(top_paths_dir)
 
-        # Create the simulation-specific directory in paths
-        self.paths_dir = os.path.join(top_paths_dir, self.sim_name)
+        # Create the simulation-specific directory in paths, or the directory
+        # of a segment of a parallel run
+        self.paths_dir = segment_dir or os.path.join(top_paths_dir, self.sim_name)
+
+        # Segments are stitched together afterwards, so they write no checkpoints
+        self.checkpoint_dir = os.path.join(self.paths_dir, 'checkpoints')
+        self.write_checkpoints = segment_dir is None
+
+        # Frames between checkpoints in the middle of a paths file, so that an
+        # incremental run starts close to the first edited frame, or 0 for a
+        # checkpoint after every paths file only
+        self.checkpoint_interval = self.sim_data.get('checkpoint_interval', self.DEFAULT_CHECKPOINT_INTERVAL)
+
+        self.stats_only = stats_only
+        if stats_only and (incremental or resume or start_frame is not None):
+            raise Exception('Stats-only runs record no paths, so they cannot resume')
+
+        # Frame to start writing paths from, or None if they are up to date,
+        # and the checkpoint to continue from, if any
+        self.resume_frame = 0
+        checkpoint = None
+        if incremental:
+            self.resume_frame, checkpoint = self.find_resume_frame()
+        elif resume or start_frame is not None:
+            self.resume_frame, checkpoint = self.find_checkpoint(start_frame)
+
+        if self.resume_frame == 0 and not stats_only:
+            if os.path.exists(self.paths_dir):
+                shutil.rmtree(self.paths_dir)
+            os.makedirs(self.paths_dir)
+
+        # Chunks written so far and their keyframes
+        self.paths_index = PathsIndex(self.paths_dir)
+
+        # Whether states are being recorded, off while replaying kept frames
+        self.writing = True
 
-        if os.path.exists(self.paths_dir):
-            shutil.rmtree(self.paths_dir)
-        os.makedirs(self.paths_dir)
+        # Whether to write a checkpoint before the next frame, which is set
+        # after every paths file, and the frame of the last checkpoint
+        self.checkpoint_due = False
+        self.checkpoint_frame = 0
 
         # First frame that we are currently holding states for in memory
         self.new_file_frame = self.frame
@@ -121,10 +241,40 @@ class Simulation:
 
         self.full_state = None
 
+        # Last state in the event log of each bot, rod and the stage, and the
+        # last script ID
+        self.event_bots = [None] * len(self.bots)
+        self.event_rods = {}
+        self.event_stage = None
+        self.event_script = None
+
+        # Rods as of the start of the columnar chunk being held in memory, read
+        # from the previous chunk when not known
+        self.chunk_rods = None
+
         #self.record_state({})
 
         self.last_control_input = {}
 
+        # Table of distinct script stacks, indexed by ID
+        self.script_stacks = []
+        self.script_ids = {}
+        self.last_script = None
+        self.last_script_id = None
+
+        # Frames and simulated seconds spent under each script stack
+        self.script_profile = {}
+
+        # Summary metrics gathered in place of states in stats-only mode
+        self.accumulators = []
+        if stats_only:
+            for name in self.sim_data.get('stats', self.DEFAULT_STATS):
+                self.accumulators.append(get_accumulator(name)(self))
+
+        if checkpoint:
+            self.logger.info('Resuming from the checkpoint at frame %s', checkpoint['frame'])
+            self.restore_checkpoint(checkpoint)
+
     def __str__(self):
 
         """
@@ -143,6 +293,12 @@ class Simulation:
         if self.frame % 1000 == 0:
             self.logger.info('----- frame: {} time: {:.2f} -----'.format(self.frame, self.time))
 
+        if self.checkpoint_due:
+            self.save_checkpoint()
+            self.checkpoint_due = False
+        elif self.interval_checkpoint_due():
+            self.save_checkpoint(keep_states=False)
+
         # If complete, exit
         if self.controller.finished:
             self.status = self.STATUS['success']
@@ -150,68 +306,742 @@ class Simulation:
             return
 
         # Run the controller to get inputs for this time step
-        control_inputs = self.controller.step(self.frame)
+        if self.fast_forward:
+            control_inputs, frames = self.controller.step_span(self.frame)
+        else:
+            control_inputs = self.controller.step(self.frame)
         self.last_control_input = control_inputs
 
         if not control_inputs:
             return
 
-        # Update each bot based on the inputs
-        for bot in self.bots:
-            bot.update(control_inputs)
+        if self.fast_forward and self.is_idle(control_inputs):
+            if self.stop_frame is not None:
+                frames = min(frames, self.stop_frame - self.frame)
+            self.skip_frames(control_inputs, frames)
+            return
+
+        if self.fast_forward and self.engine == 'numpy' and self.drives_one_zone(control_inputs):
+            if self.stop_frame is not None:
+                frames = min(frames, self.stop_frame - self.frame)
+            self.move_frames(control_inputs, frames)
+            return
+
+        # Whether a bot can pick up a rod on this frame
+        pending_rods = bool(self.structure.pending_rods)
+
+        if self.bot_array:
+            self.bot_array.update(control_inputs)
+
+            # The structure reads bots when curing or handing out rods
+            if 'uv' in control_inputs or self.structure.pending_rods:
+                self.bot_array.sync()
+
+        else:
+            self.update_bots(control_inputs)
 
         self.structure.update(control_inputs)
 
-        self.record_state(control_inputs)
+        if not self.stats_only:
+            if self.output_format == 'events':
+                self.record_events(control_inputs, pending_rods)
+            else:
+                self.record_state(control_inputs)
+
+        for accumulator in self.accumulators:
+            accumulator.update(control_inputs)
+
+        self.profile_script(control_inputs)
 
         # Update the simulation metadata
         self.time += 1 / self.rate
         self.frame += 1
 
-    def record_state(self, control_inputs):
+    def update_bots(self, control_inputs):
+        """
+        Update the bots in the zones being driven, in order.
 
-        if self.frame % FRAMES_PER_STATE == 0:
+        """
+
+        zones = [key for key in control_inputs if key in self.zone_bots]
+        if len(zones) == 1:
+            bot_indices = sorted(self.zone_bots[zones[0]])
+        else:
+            bot_indices = sorted(set().union(*[self.zone_bots[zone] for zone in zones]))
+
+        for i in bot_indices:
+            bot = self.bots[i]
+            node = bot.node
+            bot.update(control_inputs)
+            if bot.node != node:
+                self.index_bot(i, node, bot.node)
+
+    def index_bots(self):
+        """
+        Build the index of the bots each zone can move, and the bot array of
+        the numpy or tracks engine, from the current bot states.
+
+        """
+
+        self.zone_bots = {zone: set() for moves in self.transitions.values() for zone in moves}
+        for i, bot in enumerate(self.bots):
+            self.index_bot(i, None, bot.node)
+
+        self.bot_array = None
+        if self.engine == 'numpy':
+            self.bot_array = BotArray(self.bots, self.node_table, self.transitions, self.rotation_table)
+        elif self.engine == 'tracks':
+            self.bot_array = BotTracks(self, self.sim_data.get('track_processes'))
+
+    def index_bot(self, i, old_node, new_node):
+        """
+        Move the bot with the given index from the zones of its old node to
+        those of its new node.
+
+        """
+
+        if old_node is not None:
+            for zone in self.transitions[old_node]:
+                self.zone_bots[zone].discard(i)
+
+        for zone in self.transitions[new_node]:
+            self.zone_bots[zone].add(i)
+
+    def is_idle(self, control_inputs):
+        """
+        Whether the given control inputs only wait, so that neither the bots nor
+        the structure change while they are applied.
+
+        """
+
+        # A rod waiting to be fed is picked up by whichever bot gets close
+        if self.structure.pending_rods:
+            return False
+
+        for key in control_inputs:
+            if not self.is_wait_input(key):
+                return False
 
-            s = SimulationState(self.frame)
+        return True
 
-            s.set_bots(self.bot_dict, self.full_state)
-            s.set_structure(self.structure, self.full_state)
+    @staticmethod
+    def is_wait_input(key):
+        return key == 'waiting' or key == 'script' or key.startswith('zonewaiting_')
+
+    def drives_one_zone(self, control_inputs):
+        """
+        Whether the given control inputs drive a single zone and otherwise only
+        wait, so that only the bots of that zone change while they are applied.
+        Stats-only runs sum bot travel and event logs record moves frame by
+        frame, so they step as usual.
+
+        """
+
+        if self.structure.pending_rods or self.accumulators or self.output_format == 'events':
+            return False
+
+        zones = 0
+        for key in control_inputs:
+            if key in self.zone_bots:
+                zones += 1
+            elif not self.is_wait_input(key):
+                return False
+
+        return zones == 1
+
+    def skip_frames(self, control_inputs, frames):
+        """
+        Advance over a span of idle frames at once. Only the frames that record a
+        state are visited, and since nothing moves, only the first of those
+        needs to look at the bots and structure. Time is still summed frame by
+        frame so that it matches stepping through the span.
+
+        """
+
+        dt = 1 / self.rate
+        end_frame = self.frame + frames
+        unchanged = False
+
+        # Only the script can change, on the first frame
+        events = self.output_format == 'events' and not self.stats_only
+        if events:
+            self.record_events(control_inputs)
+
+        while self.frame < end_frame:
+
+            if self.frame % FRAMES_PER_STATE == 0 and not self.stats_only and not events:
+                self.record_state(control_inputs, unchanged)
+                unchanged = True
+
+            next_frame = min(end_frame, self.frame - self.frame % FRAMES_PER_STATE + FRAMES_PER_STATE)
+            for i in range(next_frame - self.frame):
+                self.time += dt
+            self.frame = next_frame
+
+        for accumulator in self.accumulators:
+            accumulator.update(control_inputs, frames)
+
+        self.profile_script(control_inputs, frames)
+
+    def move_frames(self, control_inputs, frames):
+        """
+        Advance over a span of frames that drive one zone the same way. The bot
+        array jumps the bots to each frame that records a state at once, rather
+        than stepping them one move per frame.
+
+        """
+
+        dt = 1 / self.rate
+        end_frame = self.frame + frames
+
+        while self.frame < end_frame:
+
+            # The state recorded on a frame includes the move of that frame
+            if self.frame % FRAMES_PER_STATE == 0:
+                next_frame = self.frame + 1
+            else:
+                next_frame = min(end_frame, self.frame - self.frame % FRAMES_PER_STATE + FRAMES_PER_STATE)
+
+            self.bot_array.advance(control_inputs, next_frame - self.frame)
+
+            if not self.stats_only:
+                self.record_state(control_inputs)
+
+            for i in range(next_frame - self.frame):
+                self.time += dt
+            self.frame = next_frame
+
+        self.profile_script(control_inputs, frames)
+
+    def record_state(self, control_inputs, unchanged=False):
+        """
+        Record the state of the current frame, if it is one that gets recorded.
+        If unchanged, the bots and structure are known to be the same as in the
+        last recorded state.
+
+        """
+
+        if self.frame % FRAMES_PER_STATE == 0:
 
             if 'script' in control_inputs:
-                s.set_scripts(control_inputs['script'], self.time, self.full_state)
+                script_id = self.script_id(control_inputs['script'])
+
+            if self.bot_array and not unchanged:
+                self.bot_array.sync()
 
-            self.states[self.frame] = s.serialize()
+            keyframe = self.is_keyframe(self.frame)
+
+            if self.writing:
+                s = SimulationState(self.frame)
+
+                if not unchanged:
+                    s.set_bots(self.bot_dict, self.full_state)
+                    s.set_structure(self.structure, self.full_state)
+
+                if 'script' in control_inputs:
+                    s.set_scripts(script_id, self.time, self.full_state)
+
+                if self.output_format == 'pickle' and not keyframe:
+                    self.states[self.frame] = s.serialize()
 
             # Update full_state with everything
             if not self.full_state:
                 self.full_state = SimulationState(self.frame)
             else:
                 self.full_state.frame = self.frame
-            self.full_state.set_bots(self.bot_dict)
-            self.full_state.set_structure(self.structure)
+            if not unchanged:
+                self.full_state.set_bots(self.bot_dict)
+                self.full_state.set_structure(self.structure)
             if 'script' in control_inputs:
-                self.full_state.set_scripts(control_inputs['script'], self.time)
+                self.full_state.set_scripts(script_id, self.time)
+
+            if self.writing and self.output_format == 'columns':
+                self.states[self.frame] = state_row(self.full_state, s.rods, self.bots)
+            elif self.writing and keyframe:
+                self.states[self.frame] = self.full_state.serialize()
+
+        if len(self.states) >= STATES_PER_FILE:
+            self.dump_data()
+
+    def record_events(self, control_inputs, pending_rods=False):
+        """
+        Add what changed on the current frame to the event log: the bots that
+        moved, rods that changed, the stage position and the script. If
+        pending_rods, a bot could have picked up a rod.
+
+        """
+
+        first = self.event_stage is None
+
+        # Bots only move when a zone is driven
+        bots = []
+        if first or any(key in self.zone_bots for key in control_inputs):
+            if self.bot_array:
+                self.bot_array.sync()
+            for i, bot in enumerate(self.bots):
+                bot_state = bot.node_id, bot.rot
+                if bot_state != self.event_bots[i]:
+                    self.event_bots[i] = bot_state
+                    bots.append((i,) + bot_state)
+
+        rods = {}
+        stage = None
+        if first or pending_rods or 'feed' in control_inputs or 'uv' in control_inputs or 'stagerel' in control_inputs:
+            for rod_id, rod in self.structure.rods.items():
+                rod_data = SimulationState.rod_data(rod)
+                if rod_data != self.event_rods.get(rod_id):
+                    self.event_rods[rod_id] = rods[rod_id] = rod_data
+
+            stage_pos = tuple(self.structure.pos/24)
+            if stage_pos != self.event_stage:
+                self.event_stage = stage = stage_pos
+
+        script = None
+        if 'script' in control_inputs:
+            script_id = self.script_id(control_inputs['script'])
+            if script_id != self.event_script:
+                self.event_script = script_id
+                script = script_id, self.time
+
+        if self.writing and (bots or rods or stage or script):
+            self.states[self.frame] = tuple(bots), rods, stage, script
 
         if len(self.states) >= STATES_PER_FILE:
             self.dump_data()
 
+    def reset_events(self):
+        """
+        Take the current bots, rods and stage as already in the event log.
+
+        """
+
+        self.event_bots = [(b.node_id, b.rot) for b in self.bots]
+        self.event_rods = {rod_id: SimulationState.rod_data(rod) for rod_id, rod in self.structure.rods.items()}
+        self.event_stage = tuple(self.structure.pos/24)
+
+    def is_keyframe(self, frame):
+        """
+        Whether the state of the given frame is recorded in full.
+        """
+        if self.output_format == 'events' or not self.keyframe_interval:
+            return False
+
+        return frame % (self.keyframe_interval * FRAMES_PER_STATE) == 0
+
+    def script_id(self, script):
+        """
+        Return the ID of the given script stack, adding it to the table if new.
+        Script stacks from the trajectory are interned, so an unchanged stack
+        is recognized by identity.
+        """
+
+        if script is not self.last_script:
+            if script not in self.script_ids:
+                self.script_ids[script] = len(self.script_stacks)
+                self.script_stacks.append(script)
+            self.last_script = script
+            self.last_script_id = self.script_ids[script]
+
+        return self.last_script_id
+
+    def profile_script(self, control_inputs, frames=1):
+        """
+        Attribute the given number of frames to the script stack of the
+        control inputs.
+        """
+
+        script = control_inputs.get('script')
+
+        totals = self.script_profile.get(script)
+        if totals is None:
+            totals = self.script_profile[script] = [0, 0.0]
+
+        totals[0] += frames
+        totals[1] += frames / self.rate
+
     def run(self):
         """
         Main loop, update until all jobs are complete.
 
         """
 
+        if self.resume_frame is None:
+            self.logger.info('Paths of %s are up to date', self.sim_name)
+            return self.sim_name
+
+        # A checkpoint already holds the states after the kept paths files
+        if self.frame < self.resume_frame:
+            self.replay(self.resume_frame)
+
         while not self.to_exit:
             self.update()
 
+        if self.bot_array:
+            self.bot_array.sync()
+
+        if self.stats_only:
+            self.dump_stats()
+            return self.sim_name
+
         # Dump the rest of the states
         self.dump_data()
 
         # Dump the simulation metadata
         self.dump_meta()
 
+        # Dump the per-script profile
+        self.dump_profile()
+
         return self.sim_name
 
+    def run_segment(self, state, end_frame=None):
+        """
+        Simulate from the given checkpoint data up to end_frame, or to the end of
+        the routine if None, and write the states. Returns the checkpoint data
+        at the end, for checking against the start of the next segment.
+
+        """
+
+        self.end_frame = end_frame
+        self.restore_checkpoint(state)
+
+        self.stop_frame = end_frame
+        while not self.to_exit and (end_frame is None or self.frame < end_frame):
+            self.update()
+
+        if self.states:
+            self.dump_data()
+
+        return self.checkpoint_data()
+
+    def replay(self, frame):
+        """
+        Simulate up to the given frame without recording states, since the paths
+        files before it are kept from a previous run. The full state is still
+        tracked so that recorded states after it are correct deltas.
+
+        """
+
+        self.logger.info('Replaying up to frame %s', frame)
+
+        self.writing = False
+        self.stop_frame = frame
+        while self.frame < frame and not self.to_exit:
+            self.update()
+        self.stop_frame = None
+        self.writing = True
+
+        self.new_file_frame = self.frame
+        self.states = {}
+
+    def find_resume_frame(self):
+        """
+        Compare the script digests of the previous run with the current ones,
+        and find where to resume from. That is the latest checkpoint before the
+        earliest affected frame if there is one, else the start of the paths
+        file containing that frame, to be replayed up to. Returns the first
+        frame of paths to write, or None if no script changed, and the
+        checkpoint. Only script edits are detected, not changes to the
+        simulation file or map.
+
+        """
+
+        meta_file = os.path.join(self.paths_dir, 'meta.yml')
+        if not os.path.isfile(meta_file):
+            self.logger.info('No previous paths for %s, simulating from the start', self.sim_name)
+            return 0, None
+
+        with open(meta_file) as f:
+            meta = yaml.load(f.read())
+
+        if not meta or 'dependencies' not in meta:
+            self.logger.info('Previous paths have no script digests, simulating from the start')
+            return 0, None
+
+        builder = self.controller.builder
+        changed = builder.changed_scripts(meta['dependencies'])
+        if not changed:
+            return None, None
+
+        first_frame = builder.first_frame(changed)
+        if first_frame is None:
+            first_frame = 0
+
+        self.logger.info('Changed scripts: %s', ', '.join(sorted(changed)))
+
+        # Checkpoints after the first affected frame came from the old scripts,
+        # the ones before it are valid for the new scripts too
+        self.remove_checkpoints(first_frame)
+        checkpoint = self.load_checkpoint(first_frame)
+        if checkpoint:
+            self.save_dependencies()
+            resume_frame = checkpoint['new_file_frame']
+            self.logger.info('First affected frame is %s, resuming from the checkpoint at frame %s',
+                             first_frame, checkpoint['frame'])
+        else:
+            file_frames = self.paths_file_frames()
+            resume_frame = max([f for f in file_frames if f <= first_frame], default=0)
+            self.logger.info('First affected frame is %s, resuming from frame %s', first_frame, resume_frame)
+
+        self.remove_paths(resume_frame)
+
+        return resume_frame, checkpoint
+
+    def find_checkpoint(self, start_frame=None):
+        """
+        Find the latest checkpoint, or the latest one at or before start_frame,
+        for resuming an interrupted run. Returns the first frame of paths to
+        write and the checkpoint, or 0 and None to start over.
+
+        """
+
+        checkpoint = self.load_checkpoint(start_frame)
+        if not checkpoint:
+            self.logger.info('No checkpoint to resume %s from, simulating from the start', self.sim_name)
+            return 0, None
+
+        with open(os.path.join(self.checkpoint_dir, 'dependencies.yml')) as f:
+            dependencies = yaml.load(f.read())
+
+        if self.controller.builder.changed_scripts(dependencies):
+            raise Exception('Scripts of {} changed since the checkpoint at frame {}, run incrementally instead'.format(
+                self.sim_name, checkpoint['frame']
+            ))
+
+        self.remove_paths(checkpoint['new_file_frame'])
+
+        return checkpoint['new_file_frame'], checkpoint
+
+    def paths_files(self, paths_dir=None):
+        """
+        Names of the paths files in the paths directory, or the given one, by
+        their first frame. Columnar chunks are directories named by their first
+        frame, and compressed pickles end in the extension of their codec.
+
+        """
+
+        paths_dir = paths_dir or self.paths_dir
+
+        if self.output_format != 'pickle':
+            return {
+                int(name): name for name in os.listdir(paths_dir)
+                if name.isdigit() and os.path.isdir(os.path.join(paths_dir, name))
+            }
+
+        return {
+            int(name.split('.')[0]): name for name in os.listdir(paths_dir)
+            if split_extension(name)[0].endswith('.pickle')
+        }
+
+    def paths_file_frames(self, paths_dir=None):
+        return sorted(self.paths_files(paths_dir))
+
+    def load_paths(self, frame, paths_dir=None):
+        """
+        Return the states of the paths file starting at the given frame, as held
+        in memory before writing it.
+
+        """
+
+        paths_dir = paths_dir or self.paths_dir
+        name = self.paths_files(paths_dir)[frame]
+
+        if self.output_format == 'columns':
+            return chunk_rows(os.path.join(paths_dir, name), [b.name for b in self.bots])
+
+        if self.output_format == 'events':
+            return read_events(os.path.join(paths_dir, name), [b.name for b in self.bots])
+
+        with open(os.path.join(paths_dir, name), 'rb') as f:
+            return pickle.loads(decompress(f.read(), split_extension(name)[1]))
+
+    def remove_paths(self, frame):
+        """
+        Remove the paths files from the given frame on, which will be written
+        again, along with the metadata so that an interrupted run is never
+        mistaken for a complete one.
+
+        """
+
+        meta_file = os.path.join(self.paths_dir, 'meta.yml')
+        if os.path.isfile(meta_file):
+            os.remove(meta_file)
+
+        PathsIndex(self.paths_dir).remove(frame)
+
+        for f, name in self.paths_files().items():
+            if f >= frame:
+                if self.output_format != 'pickle':
+                    shutil.rmtree(os.path.join(self.paths_dir, name))
+                else:
+                    os.remove(os.path.join(self.paths_dir, name))
+
+    def checkpoint_frames(self):
+
+        if not os.path.isdir(self.checkpoint_dir):
+            return []
+
+        return sorted(
+            int(name.split('.')[0]) for name in os.listdir(self.checkpoint_dir)
+            if name.endswith('.pickle')
+        )
+
+    def remove_checkpoints(self, frame):
+        """
+        Remove the checkpoints after the given frame.
+
+        """
+
+        for f in self.checkpoint_frames():
+            if f > frame:
+                os.remove(os.path.join(self.checkpoint_dir, '{}.pickle'.format(f)))
+
+    def load_checkpoint(self, max_frame=None):
+        """
+        Return the data of the latest checkpoint, or the latest one at or before
+        max_frame, or None if there is none. A checkpoint without its states is
+        skipped if the paths file to read them from was never written.
+
+        """
+
+        frames = [f for f in self.checkpoint_frames() if max_frame is None or f <= max_frame]
+
+        for frame in reversed(frames):
+
+            with open(os.path.join(self.checkpoint_dir, '{}.pickle'.format(frame)), 'rb') as f:
+                data = pickle.load(f)
+
+            if data['states'] is None:
+                data['states'] = self.written_states(data['new_file_frame'], frame)
+
+            if data['states'] is not None:
+                return data
+
+        return None
+
+    def written_states(self, file_frame, frame):
+        """
+        Return the states before the given frame from the paths file starting at
+        file_frame, or None if there is no such file.
+
+        """
+
+        if file_frame not in self.paths_files():
+            return None
+
+        return {f: state for f, state in self.load_paths(file_frame).items() if f < frame}
+
+    def interval_checkpoint_due(self):
+        """
+        Whether a checkpoint interval has passed since the last checkpoint.
+
+        """
+
+        if not self.checkpoint_interval or not self.write_checkpoints:
+            return False
+
+        if self.stats_only or not self.writing:
+            return False
+
+        return self.frame - self.checkpoint_frame >= self.checkpoint_interval
+
+    def checkpoint_data(self):
+        """
+        Return everything needed to continue from the start of the current frame
+        with identical output: bots, structure, the frame and time that the
+        controller is stepped with, and the states not yet written to a paths
+        file along with the tables they refer to.
+
+        """
+
+        if self.bot_array:
+            self.bot_array.sync()
+
+        return {
+            'frame': self.frame,
+            'time': self.time,
+            'rate': self.rate,
+            'bots': {b.name: b.get_state() for b in self.bots},
+            'structure': self.structure.get_state(),
+            'new_file_frame': self.new_file_frame,
+            'states': self.states,
+            'full_state': self.full_state.serialize() if self.full_state else None,
+            'event_script': self.event_script,
+            'script_stacks': self.script_stacks,
+            'script_profile': self.script_profile
+        }
+
+    def save_checkpoint(self, keep_states=True):
+        """
+        Write a checkpoint of the start of the current frame. Unless keep_states,
+        the states held in memory are left out, and read back from the paths file
+        they end up in when the checkpoint is loaded.
+
+        """
+
+        data = self.checkpoint_data()
+        if not keep_states:
+            data['states'] = None
+
+        self.checkpoint_frame = self.frame
+
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+            self.save_dependencies()
+
+        # Write to a temporary file first so that a crash never leaves a
+        # partial checkpoint
+        checkpoint_file = os.path.join(self.checkpoint_dir, '{}.pickle'.format(self.frame))
+        tmp_file = checkpoint_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(data, f)
+        os.replace(tmp_file, checkpoint_file)
+
+        self.logger.info('Saved checkpoint at frame %s', self.frame)
+
+    def save_dependencies(self):
+        """
+        Record the script digests that the checkpoints were simulated with.
+
+        """
+
+        with open(os.path.join(self.checkpoint_dir, 'dependencies.yml'), 'w') as f:
+            f.write(yaml.dump(self.controller.builder.dependencies))
+
+    def restore_checkpoint(self, data):
+
+        self.frame = data['frame']
+        self.time = data['time']
+        self.rate = data['rate']
+
+        for bot in self.bots:
+            bot.set_state(data['bots'][bot.name])
+        self.index_bots()
+
+        self.structure.set_state(data['structure'])
+
+        self.new_file_frame = data['new_file_frame']
+        self.states = data['states']
+        self.checkpoint_frame = self.frame
+        self.chunk_rods = None
+        if data['full_state'] is not None:
+            self.full_state = SimulationState.deserialize(data['full_state'])
+
+            # Key the bots by the names of the bots themselves, as recording
+            # does, so that keyframes pickle the same as in an uninterrupted run
+            self.full_state.bots = {b.name: self.full_state.bots[b.name] for b in self.bots}
+
+        self.script_stacks = data['script_stacks']
+        self.script_ids = {script: i for i, script in enumerate(self.script_stacks)}
+
+        # Everything before the checkpoint is in the event log, which is still
+        # empty at the first frame
+        if self.frame > 0:
+            self.reset_events()
+        self.event_script = data['event_script']
+
+        self.script_profile = data['script_profile']
+
     def print_status(self):
 
         self.logger.info(self)
@@ -222,23 +1052,134 @@ class Simulation:
 
     def dump_data(self):
 
-        paths_file = os.path.join(self.paths_dir, '{}.pickle'.format(self.new_file_frame))
-        with open(paths_file, 'wb') as f:
-            pickle.dump(self.states, f)
+        if self.output_format == 'columns':
+            name = str(self.new_file_frame)
+            bot_names = [b.name for b in self.bots]
+
+            # Each chunk starts with all rods, so that it can be read on its own
+            if self.chunk_rods is None:
+                paths_files = self.paths_files()
+                file_frames = [f for f in paths_files if f < self.new_file_frame]
+                self.chunk_rods = chunk_end_rods(
+                    os.path.join(self.paths_dir, paths_files[max(file_frames)]), bot_names
+                ) if file_frames else {}
+
+            size = write_chunk(os.path.join(self.paths_dir, name), self.states, bot_names,
+                               self.chunk_rods, self.compression)
+            self.chunk_rods = apply_rods(self.chunk_rods, [self.states[f] for f in sorted(self.states)])
+
+        elif self.output_format == 'events':
+            name = str(self.new_file_frame)
+            size = write_events(os.path.join(self.paths_dir, name), self.states,
+                                [b.name for b in self.bots], self.compression)
+
+        else:
+            name = '{}.pickle{}'.format(self.new_file_frame, extension(self.compression))
+            data = compress(pickle.dumps(self.states), self.compression)
+            with open(os.path.join(self.paths_dir, name), 'wb') as f:
+                f.write(data)
+            size = len(data)
+
+        self.paths_index.add(
+            name,
+            self.new_file_frame,
+            list(self.states),
+            [f for f in self.states if self.is_keyframe(f)],
+            size,
+            self.compression
+        )
 
-        self.new_file_frame = self.frame + FRAMES_PER_STATE
+        # Events can happen on any frame, states only on recorded ones
+        if self.output_format == 'events':
+            self.new_file_frame = self.frame + 1
+        else:
+            self.new_file_frame = self.frame + FRAMES_PER_STATE
         self.states = {}
 
+        self.checkpoint_due = self.write_checkpoints
+
     def dump_meta(self):
 
+        meta = {
+            'sim_name': self.sim_name,
+            'format': self.output_format,
+            'num_frames': self.frame,
+            'num_rods': len(self.structure.rods),
+            'num_bots': len(self.bots),
+            'end_time': self.time,
+            'bots': {b.name: b.type for b in self.bots},
+            'rods': {rod_id: rod['type'] for rod_id, rod in self.structure.rods.items()},
+            'scripts': [
+                [list(s) if isinstance(s, tuple) else s for s in script]
+                for script in self.script_stacks
+            ],
+            'dependencies': self.controller.builder.dependencies
+        }
+
+        # Columns and events of bots are in the order of the bots, and their
+        # nodes index the grid positions in nodes.npy
+        if self.output_format != 'pickle':
+            meta['bot_columns'] = [b.name for b in self.bots]
+            np.save(os.path.join(self.paths_dir, 'nodes.npy'), np.array(self.node_table.grid, dtype=float))
+
+        # An event log only holds the time of script changes, and the time of
+        # any other frame is worked out from the rate
+        if self.output_format == 'events':
+            meta['rate'] = self.rate
+
         meta_file = os.path.join(self.paths_dir, 'meta.yml')
         with open(meta_file, 'w') as f:
+            f.write(yaml.dump(meta))
+
+    def dump_stats(self):
+        """
+        Write the metadata of a stats-only run and the result of each
+        accumulator to spec/stats.
+
+        """
+
+        stats_dir = os.path.join(gridbots.path, 'spec', 'stats')
+        if not os.path.exists(stats_dir):
+            os.makedirs(stats_dir)
+
+        stats_file = os.path.join(stats_dir, '{}.yml'.format(self.sim_name))
+        with open(stats_file, 'w') as f:
             f.write(yaml.dump({
                 'sim_name': self.sim_name,
                 'num_frames': self.frame,
                 'num_rods': len(self.structure.rods),
+                'num_rods_done': sum(1 for rod in self.structure.rods.values() if rod['done']),
                 'num_bots': len(self.bots),
                 'end_time': self.time,
-                'bots': {b.name: b.type for b in self.bots},
-                'rods': {rod_id: rod['type'] for rod_id, rod in self.structure.rods.items()}
-                }))
+                'stats': {a.name: a.result() for a in self.accumulators}
+            }))
+
+    def dump_profile(self):
+        """
+        Write the frames and simulated seconds spent in each script stack in
+        collapsed stack format, which flame graph tools read directly. Frame
+        counts go in profile.folded and seconds in profile_time.folded.
+        """
+
+        frames = {}
+        seconds = {}
+        for script, (script_frames, script_seconds) in self.script_profile.items():
+
+            names = []
+            for s in script or ['unknown']:
+                if isinstance(s, tuple):
+                    s = '+'.join(s)
+                if s:
+                    names.append(s)
+            stack = ';'.join(names)
+
+            frames[stack] = frames.get(stack, 0) + script_frames
+            seconds[stack] = seconds.get(stack, 0.0) + script_seconds
+
+        with open(os.path.join(self.paths_dir, 'profile.folded'), 'w') as f:
+            for stack in sorted(frames):
+                f.write('{} {}\n'.format(stack, frames[stack]))
+
+        with open(os.path.join(self.paths_dir, 'profile_time.folded'), 'w') as f:
+            for stack in sorted(seconds):
+                f.write('{} {:.6f}\n'.format(stack, seconds[stack]))
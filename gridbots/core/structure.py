@@ -61,6 +61,42 @@ class Structure:
 
         return rod_id
 
+    def get_state(self):
+        """
+        Stage position, rods and pending pickups as plain data for a checkpoint.
+        """
+
+        rods = {}
+        for rod_id, rod in self.rods.items():
+            rods[rod_id] = dict(rod, pos=tuple(rod['pos']) if rod['pos'] is not None else None)
+
+        return {
+            'pos': tuple(self.pos),
+            'rods': rods,
+            'rod_id': self.rod_id,
+            'pending_rods': set(self.pending_rods)
+        }
+
+    def set_state(self, state):
+        """
+        Restore the structure from get_state data.
+        """
+
+        self.pos = mu.Vector(state['pos'])
+
+        # Rods refer to the name of their bot itself, so that recorded states
+        # pickle the same as in an uninterrupted run
+        self.rods = {}
+        for rod_id, rod in state['rods'].items():
+            self.rods[rod_id] = dict(
+                rod,
+                bot=self.sim.bot_dict[rod['bot']].name if rod['bot'] else None,
+                pos=mu.Vector(rod['pos']) if rod['pos'] is not None else None
+            )
+
+        self.rod_id = state['rod_id']
+        self.pending_rods = set(state['pending_rods'])
+
     def update(self, control_inputs):
 
         # Process stage movements
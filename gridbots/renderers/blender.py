@@ -12,6 +12,10 @@ import logging
 
 import gridbots
 from gridbots.utils.simstate import SimulationState
+from gridbots.utils.columns import PathColumns
+from gridbots.utils.events import EventLog
+from gridbots.utils.paths_index import PathsIndex
+from gridbots.utils.compression import decompress
 from gridbots.core.simulation import STATES_PER_FILE
 from gridbots.core.simulation import FRAMES_PER_STATE
 
@@ -39,7 +43,8 @@ class BlenderDrawer():
 
         self.logger = logging.getLogger(__name__)
 
-        meta_path = os.path.join(gridbots.path, 'spec', 'paths', sim_name, 'meta.yml')
+        self.paths_dir = os.path.join(gridbots.path, 'spec', 'paths', sim_name)
+        meta_path = os.path.join(self.paths_dir, 'meta.yml')
         with open(meta_path) as f:
             data = yaml.load(f.read())
             self.sim_name = data['sim_name']
@@ -49,6 +54,19 @@ class BlenderDrawer():
             self.bot_data = data['bots']
             self.rod_data = data['rods']
             self.end_time = data['end_time']
+            self.script_stacks = data['scripts']
+
+        # Columnar paths hold complete states, read straight from their chunks,
+        # and an event log gives the complete state of any frame
+        self.reader = None
+        self.events = data.get('format', 'pickle') == 'events'
+        if data.get('format', 'pickle') == 'columns':
+            self.reader = PathColumns(self.paths_dir, data['bot_columns'])
+        elif self.events:
+            self.reader = EventLog(self.paths_dir, data['bot_columns'], data['rate'])
+
+        # Paths files and keyframes, empty for paths written without an index
+        self.index = PathsIndex(self.paths_dir)
 
         # TODO read from data
         self.rate = DEFAULT_RATE
@@ -149,20 +167,30 @@ class BlenderDrawer():
     def get_state(self, exact_frame):
 
         frame = exact_frame - exact_frame % FRAMES_PER_STATE
+
+        if self.events:
+            return self.reader.state(exact_frame)
+
+        if self.reader:
+            return self.reader.state(frame)
+
         if frame not in self.states:
 
-            base_frame = frame - frame % (STATES_PER_FILE * FRAMES_PER_STATE)
-            paths_file = os.path.join(
-                gridbots.path, 'spec', 'paths', self.sim_name,
-                '{}.pickle'.format(base_frame)
-            )
+            chunk = self.index.chunk(frame)
+            if chunk:
+                paths_file = os.path.join(self.paths_dir, chunk['file'])
+                codec = chunk['codec']
+            else:
+                base_frame = frame - frame % (STATES_PER_FILE * FRAMES_PER_STATE)
+                paths_file = os.path.join(self.paths_dir, '{}.pickle'.format(base_frame))
+                codec = 'none'
 
             if not os.path.isfile(paths_file):
                 self.logger.error('Did not find paths file: {}'.format(paths_file))
                 return None
 
             with open(paths_file, 'rb') as f:
-                self.states = pickle.load(f)
+                self.states = pickle.loads(decompress(f.read(), codec))
 
         return SimulationState.deserialize(self.states[frame])
 
@@ -171,8 +199,25 @@ class BlenderDrawer():
         old_frame = self.state.frame
         new_frame = self.frame_int - self.frame_int % FRAMES_PER_STATE
 
+        if self.events:
+            if self.frame_int != old_frame:
+                self.state = self.get_state(self.frame_int)
+            return
+
+        if self.reader:
+            if new_frame != old_frame:
+                self.state = self.get_state(new_frame)
+            return
+
         # self.logger.info('Old frame: {}, new frame: {}'.format(old_frame, new_frame))
 
+        # Start over from the last keyframe when going back, or when it is closer
+        # than the current state, so a seek takes at most a keyframe interval
+        keyframe = self.index.keyframe(new_frame)
+        if keyframe is not None and (new_frame < old_frame or keyframe > old_frame):
+            self.state = self.get_state(keyframe)
+            old_frame = keyframe
+
         num_frames = int((new_frame - old_frame)/FRAMES_PER_STATE)
 
         if num_frames >= 0:
@@ -184,8 +229,8 @@ class BlenderDrawer():
             state = self.get_state(frame)
             self.state.bots.update(state.bots)
             self.state.rods.update(state.rods)
-            if state.scripts:
-                self.state.scripts = state.scripts
+            if state.script_id is not None:
+                self.state.script_id = state.script_id
             if state.time:
                 self.state.time = state.time
             if state.structure:
@@ -282,7 +327,8 @@ class BlenderDrawer():
         self.text['status'].text = 'Status: {}'.format(state_text)
 
         self.text['scripts'].text = ''
-        for script in state.scripts:
+        scripts = self.script_stacks[state.script_id] if state.script_id is not None else []
+        for script in scripts:
             if script == 'simscript' or not script:
                 continue
             self.text['scripts'].text += '\n' + str(script)
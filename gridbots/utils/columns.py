@@ -0,0 +1,281 @@
+"""
+
+"""
+
+import io
+import os
+
+import numpy as np
+
+from gridbots.utils.simstate import SimulationState
+from gridbots.utils.compression import compress, decompress, extension
+from gridbots.utils.paths_index import PathsIndex
+
+# Arrays of a chunk, one .npy file each. Bots are in the order of the meta
+# file's bot_columns, and rod rows hold the rods that changed on their frame,
+# after rows with frame -1 that hold every rod as it was before the chunk.
+COLUMNS = (
+    'frame', 'time', 'script_id', 'stage', 'bot_node', 'bot_rot',
+    'rod_frame', 'rod_id', 'rod_bot', 'rod_pos', 'rod_rot', 'rod_done'
+)
+
+
+def state_row(full_state, rods, bots):
+    """
+    Row of the columnar paths format for a recorded state: time, script ID and
+    stage position as of that frame, node index and rotation of every bot, and
+    the given rods that changed.
+    """
+
+    return (
+        full_state.time,
+        full_state.script_id,
+        full_state.structure,
+        tuple(b.node_id for b in bots),
+        tuple(b.rot for b in bots),
+        rods
+    )
+
+
+def apply_rods(rods, rows):
+    """
+    Return the rods after the changes of the given rows.
+    """
+
+    rods = dict(rods)
+    for row in rows:
+        rods.update(row[5])
+    return rods
+
+
+def write_chunk(chunk_dir, rows, bot_names, rods_before, codec='none'):
+    """
+    Write the given rows, by frame, as a directory of arrays, each compressed
+    with the given codec. Returns the number of bytes written.
+    """
+
+    frames = sorted(rows)
+
+    rod_rows = [(-1, rod_id, rod) for rod_id, rod in sorted(rods_before.items())]
+    for frame in frames:
+        rod_rows.extend((frame, rod_id, rod) for rod_id, rod in sorted(rows[frame][5].items()))
+
+    columns = {
+        'frame': np.array(frames, dtype=np.int64),
+        'time': np.array([rows[f][0] for f in frames], dtype=float),
+        'script_id': np.array([-1 if rows[f][1] is None else rows[f][1] for f in frames], dtype=np.int32),
+        'stage': np.array([rows[f][2] for f in frames], dtype=float).reshape(len(frames), 3),
+        'bot_node': np.array([rows[f][3] for f in frames], dtype=np.int32).reshape(len(frames), len(bot_names)),
+        'bot_rot': np.array([rows[f][4] for f in frames], dtype=float).reshape(len(frames), len(bot_names))
+    }
+    columns.update(rod_arrays(rod_rows, bot_names))
+
+    return write_arrays(chunk_dir, columns, codec)
+
+
+def rod_arrays(rod_rows, bot_names):
+    """
+    Rod arrays of the given (frame, rod ID, rod data) rows, with rod data as in
+    SimulationState.
+    """
+
+    bot_index = {name: i for i, name in enumerate(bot_names)}
+    nan3 = (np.nan, np.nan, np.nan)
+
+    return {
+        'rod_frame': np.array([r[0] for r in rod_rows], dtype=np.int64),
+        'rod_id': np.array([r[1] for r in rod_rows], dtype=np.int32),
+        'rod_bot': np.array([-1 if r[2][0] is None else bot_index[r[2][0]] for r in rod_rows], dtype=np.int32),
+        'rod_pos': np.array([r[2][1] or nan3 for r in rod_rows], dtype=float).reshape(len(rod_rows), 3),
+        'rod_rot': np.array([r[2][2] or nan3 for r in rod_rows], dtype=float).reshape(len(rod_rows), 3),
+        'rod_done': np.array([r[2][3] for r in rod_rows], dtype=bool)
+    }
+
+
+def write_arrays(chunk_dir, arrays, codec='none'):
+    """
+    Write arrays by name as .npy files in a directory, each compressed with the
+    given codec. Returns the number of bytes written.
+    """
+
+    if not os.path.exists(chunk_dir):
+        os.makedirs(chunk_dir)
+
+    size = 0
+    for name, array in arrays.items():
+        array_file = os.path.join(chunk_dir, name + '.npy' + extension(codec))
+        if codec == 'none':
+            np.save(array_file, array)
+        else:
+            buffer = io.BytesIO()
+            np.save(buffer, array)
+            with open(array_file, 'wb') as f:
+                f.write(compress(buffer.getvalue(), codec))
+        size += os.path.getsize(array_file)
+
+    return size
+
+
+def read_arrays(chunk_dir, names, mmap_mode='r', codec=None):
+    """
+    Return the arrays of a directory written by write_arrays, by name. The
+    codec is found from the file names if not given. Uncompressed arrays are
+    memory-mapped unless mmap_mode is None, and compressed ones are read into
+    memory.
+    """
+
+    if codec is None:
+        codec = 'none'
+        for name in os.listdir(chunk_dir):
+            if name.startswith(names[0] + '.npy.'):
+                codec = name[len(names[0] + '.npy.'):]
+
+    arrays = {}
+    for name in names:
+        array_file = os.path.join(chunk_dir, name + '.npy' + extension(codec))
+        if codec == 'none':
+            arrays[name] = np.load(array_file, mmap_mode=mmap_mode)
+        else:
+            with open(array_file, 'rb') as f:
+                arrays[name] = np.load(io.BytesIO(decompress(f.read(), codec)))
+
+    return arrays
+
+
+def read_chunk(chunk_dir, mmap_mode='r', codec=None):
+    """
+    Return the arrays of a chunk by name.
+    """
+    return read_arrays(chunk_dir, COLUMNS, mmap_mode, codec)
+
+
+def rod_data(columns, i, bot_names):
+    """
+    Rod data of rod row i of a chunk, as in SimulationState.
+    """
+
+    bot = int(columns['rod_bot'][i])
+    pos = columns['rod_pos'][i]
+    rot = columns['rod_rot'][i]
+    return (
+        bot_names[bot] if bot >= 0 else None,
+        None if np.isnan(pos[0]) else tuple(pos.tolist()),
+        None if np.isnan(rot[0]) else tuple(rot.tolist()),
+        bool(columns['rod_done'][i])
+    )
+
+
+def chunk_end_rods(chunk_dir, bot_names):
+    """
+    Return the rods as of the end of a chunk, by rod ID.
+    """
+
+    columns = read_chunk(chunk_dir, None)
+    return {
+        int(rod_id): rod_data(columns, i, bot_names)
+        for i, rod_id in enumerate(columns['rod_id'].tolist())
+    }
+
+
+def chunk_rows(chunk_dir, bot_names):
+    """
+    Read the rows of a chunk back, by frame.
+    """
+
+    columns = read_chunk(chunk_dir, None)
+
+    rows = {}
+    for i, frame in enumerate(columns['frame'].tolist()):
+        time = float(columns['time'][i])
+        script_id = int(columns['script_id'][i])
+        rows[frame] = (
+            None if np.isnan(time) else time,
+            None if script_id < 0 else script_id,
+            tuple(columns['stage'][i].tolist()),
+            tuple(columns['bot_node'][i].tolist()),
+            tuple(columns['bot_rot'][i].tolist()),
+            {}
+        )
+
+    for i, frame in enumerate(columns['rod_frame'].tolist()):
+        if frame >= 0:
+            rows[frame][5][int(columns['rod_id'][i])] = rod_data(columns, i, bot_names)
+
+    return rows
+
+
+class PathColumns():
+    """
+    Reader of paths in the columnar format, which finds chunks through the
+    paths index. Uncompressed chunks are memory-mapped, so a column of a chunk
+    is a zero-copy view of its file.
+
+    """
+
+    def __init__(self, paths_dir, bot_names):
+
+        self.paths_dir = paths_dir
+        self.bot_names = bot_names
+
+        # Grid position of each node, indexed by bot_node
+        self.node_grid = np.load(os.path.join(paths_dir, 'nodes.npy'), mmap_mode='r')
+
+        self.index = PathsIndex(paths_dir)
+        self.chunks = {}
+
+    def chunk(self, frame):
+        """
+        Return the arrays of the chunk holding the given frame.
+        """
+
+        entry = self.index.chunk(frame)
+        if entry is None:
+            return None
+
+        if entry['file'] not in self.chunks:
+            chunk_dir = os.path.join(self.paths_dir, entry['file'])
+            self.chunks[entry['file']] = read_chunk(chunk_dir, codec=entry['codec'])
+
+        return self.chunks[entry['file']]
+
+    def bot_positions(self, frame):
+        """
+        Grid position of every bot at the given recorded frame.
+        """
+
+        columns = self.chunk(frame)
+        i = int(np.searchsorted(columns['frame'], frame))
+        return self.node_grid[columns['bot_node'][i]]
+
+    def state(self, frame):
+        """
+        Return the complete SimulationState of the given recorded frame, or None
+        if there is no such frame.
+        """
+
+        columns = self.chunk(frame)
+        if columns is None:
+            return None
+
+        i = int(np.searchsorted(columns['frame'], frame))
+        if i == len(columns['frame']) or columns['frame'][i] != frame:
+            return None
+
+        s = SimulationState(frame)
+
+        time = float(columns['time'][i])
+        s.time = None if np.isnan(time) else time
+        script_id = int(columns['script_id'][i])
+        s.script_id = None if script_id < 0 else script_id
+        s.structure = tuple(columns['stage'][i].tolist())
+
+        grid = self.node_grid[columns['bot_node'][i]].tolist()
+        rots = columns['bot_rot'][i].tolist()
+        s.bots = {name: (tuple(pos), rot) for name, pos, rot in zip(self.bot_names, grid, rots)}
+
+        # Rods as of the frame, from the rods before the chunk and the changes
+        num_rows = int(np.searchsorted(columns['rod_frame'], frame, side='right'))
+        for j in range(num_rows):
+            s.rods[int(columns['rod_id'][j])] = rod_data(columns, j, self.bot_names)
+
+        return s
@@ -0,0 +1,74 @@
+"""
+
+"""
+
+import bz2
+import lzma
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codecs that paths files can be compressed with, which are also the file
+# extensions of compressed files. zstd needs the zstandard package.
+CODECS = ('none', 'zlib', 'bz2', 'lzma', 'zstd')
+
+
+def check_codec(codec):
+
+    if codec not in CODECS:
+        raise Exception('Unknown compression: {}, expected one of {}'.format(codec, ', '.join(CODECS)))
+
+    if codec == 'zstd' and zstandard is None:
+        raise Exception('zstd compression needs the zstandard package')
+
+
+def extension(codec):
+    """
+    Extension added to the name of a file compressed with the given codec.
+    """
+    return '' if codec == 'none' else '.' + codec
+
+
+def split_extension(name):
+    """
+    Return the name of a possibly compressed file without its codec extension,
+    and the codec.
+    """
+
+    base, _, ext = name.rpartition('.')
+    if base and ext in CODECS and ext != 'none':
+        return base, ext
+
+    return name, 'none'
+
+
+def compress(data, codec):
+
+    if codec == 'zlib':
+        return zlib.compress(data)
+    if codec == 'bz2':
+        return bz2.compress(data)
+    if codec == 'lzma':
+        return lzma.compress(data)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+
+    return data
+
+
+def decompress(data, codec):
+
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'bz2':
+        return bz2.decompress(data)
+    if codec == 'lzma':
+        return lzma.decompress(data)
+    if codec == 'zstd':
+        check_codec(codec)
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    return data
@@ -0,0 +1,161 @@
+"""
+
+"""
+
+import os
+
+import numpy as np
+
+from gridbots.utils.simstate import SimulationState
+from gridbots.utils.columns import write_arrays, read_arrays, rod_arrays, rod_data
+from gridbots.utils.paths_index import PathsIndex
+
+# Arrays of a chunk of events, one .npy file each. Every bot, rod, stage and
+# script event holds the frame it happened on and the new state.
+EVENT_ARRAYS = (
+    'bot_frame', 'bot_index', 'bot_node', 'bot_rot',
+    'rod_frame', 'rod_id', 'rod_bot', 'rod_pos', 'rod_rot', 'rod_done',
+    'stage_frame', 'stage',
+    'script_frame', 'script_id', 'script_time'
+)
+
+
+def write_events(chunk_dir, events, bot_names, codec='none'):
+    """
+    Write the given events, by frame, as a directory of arrays. The events of
+    a frame are the bots that moved as (index, node index, rotation), the rods
+    that changed by rod ID, and the new stage position and (script ID, time),
+    or None if unchanged. Returns the number of bytes written.
+    """
+
+    frames = sorted(events)
+
+    bot_rows = [(f,) + bot for f in frames for bot in events[f][0]]
+    rod_rows = [(f, rod_id, rod) for f in frames for rod_id, rod in sorted(events[f][1].items())]
+    stage_frames = [f for f in frames if events[f][2] is not None]
+    script_frames = [f for f in frames if events[f][3] is not None]
+
+    arrays = {
+        'bot_frame': np.array([r[0] for r in bot_rows], dtype=np.int64),
+        'bot_index': np.array([r[1] for r in bot_rows], dtype=np.int32),
+        'bot_node': np.array([r[2] for r in bot_rows], dtype=np.int32),
+        'bot_rot': np.array([r[3] for r in bot_rows], dtype=float),
+        'stage_frame': np.array(stage_frames, dtype=np.int64),
+        'stage': np.array([events[f][2] for f in stage_frames], dtype=float).reshape(len(stage_frames), 3),
+        'script_frame': np.array(script_frames, dtype=np.int64),
+        'script_id': np.array([events[f][3][0] for f in script_frames], dtype=np.int32),
+        'script_time': np.array([events[f][3][1] for f in script_frames], dtype=float)
+    }
+    arrays.update(rod_arrays(rod_rows, bot_names))
+
+    return write_arrays(chunk_dir, arrays, codec)
+
+
+def read_events(chunk_dir, bot_names):
+    """
+    Read the events of a chunk back, by frame.
+    """
+
+    arrays = read_arrays(chunk_dir, EVENT_ARRAYS, None)
+
+    events = {}
+
+    def frame_events(frame):
+        if frame not in events:
+            events[frame] = ([], {}, None, None)
+        return events[frame]
+
+    for frame, i, node, rot in zip(*[arrays[name].tolist() for name in EVENT_ARRAYS[:4]]):
+        frame_events(frame)[0].append((i, node, rot))
+
+    for i, frame in enumerate(arrays['rod_frame'].tolist()):
+        frame_events(frame)[1][int(arrays['rod_id'][i])] = rod_data(arrays, i, bot_names)
+
+    for frame, stage in zip(arrays['stage_frame'].tolist(), arrays['stage'].tolist()):
+        bots, rods, _, script = frame_events(frame)
+        events[frame] = bots, rods, tuple(stage), script
+
+    for frame, script_id, time in zip(*[arrays[name].tolist() for name in EVENT_ARRAYS[-3:]]):
+        bots, rods, stage, _ = frame_events(frame)
+        events[frame] = bots, rods, stage, (script_id, time)
+
+    return {frame: (tuple(e[0]),) + e[1:] for frame, e in events.items()}
+
+
+class EventLog():
+    """
+    Reader of paths in the events format. All chunks are loaded, and the state
+    of a bot at any frame is found by bisecting its own moves. The time of a
+    frame is counted at the given rate from the last script event.
+
+    """
+
+    def __init__(self, paths_dir, bot_names, rate):
+
+        self.bot_names = bot_names
+        self.rate = rate
+
+        # Grid position of each node, indexed by bot_node
+        self.node_grid = np.load(os.path.join(paths_dir, 'nodes.npy'), mmap_mode='r')
+
+        chunks = [
+            read_arrays(os.path.join(paths_dir, entry['file']), EVENT_ARRAYS, None, entry['codec'])
+            for entry in PathsIndex(paths_dir).chunks
+        ]
+        self.events = {name: np.concatenate([c[name] for c in chunks]) for name in EVENT_ARRAYS}
+
+        # Frames, nodes and rotations of each bot's moves
+        order = np.argsort(self.events['bot_index'], kind='stable')
+        bounds = np.searchsorted(self.events['bot_index'][order], np.arange(len(bot_names) + 1))
+        self.bot_moves = [
+            tuple(self.events[name][order[start:end]] for name in ('bot_frame', 'bot_node', 'bot_rot'))
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+
+    def bot_state(self, i, frame):
+        """
+        Node index and rotation of bot i as of the end of the given frame, or
+        None before its first event.
+        """
+
+        frames, nodes, rots = self.bot_moves[i]
+        j = int(np.searchsorted(frames, frame, side='right')) - 1
+        if j < 0:
+            return None
+
+        return int(nodes[j]), float(rots[j])
+
+    def last(self, name, frame):
+        """
+        Index of the last event in the given frame array at or before frame.
+        """
+        return int(np.searchsorted(self.events[name], frame, side='right')) - 1
+
+    def state(self, frame):
+        """
+        Return the complete SimulationState as of the end of the given frame.
+        """
+
+        s = SimulationState(frame)
+
+        for i, name in enumerate(self.bot_names):
+            bot = self.bot_state(i, frame)
+            if bot is not None:
+                s.bots[name] = tuple(self.node_grid[bot[0]].tolist()), bot[1]
+
+        for j in range(self.last('rod_frame', frame) + 1):
+            s.rods[int(self.events['rod_id'][j])] = rod_data(self.events, j, self.bot_names)
+
+        j = self.last('stage_frame', frame)
+        if j >= 0:
+            s.structure = tuple(self.events['stage'][j].tolist())
+
+        s.time = frame / self.rate
+
+        j = self.last('script_frame', frame)
+        if j >= 0:
+            s.script_id = int(self.events['script_id'][j])
+            script_frame = int(self.events['script_frame'][j])
+            s.time = float(self.events['script_time'][j]) + (frame - script_frame) / self.rate
+
+        return s
@@ -42,6 +42,71 @@ def pos_from_node(G, node):
     return mu.Vector([G.node[node]['x']*24, G.node[node]['y']*24, G.node[node]['z']*24])
 
 
+class NodeTable():
+    """
+    Coordinates of every node of a map, computed once when it is loaded. Nodes
+    are numbered by index, and each has a position in millimeters as a frozen
+    Vector, shared by every bot on the node, and in grid units as a tuple, as
+    recorded in simulation states.
+
+    """
+
+    def __init__(self, G):
+
+        # Node of each index, and index of each node
+        self.nodes = list(G.nodes())
+        self.index = {n: i for i, n in enumerate(self.nodes)}
+
+        self.mm = []
+        self.grid = []
+        for n in self.nodes:
+            pos = mu.Vector([G.node[n]['x'], G.node[n]['y'], G.node[n]['z']]) * 24
+            pos.freeze()
+            self.mm.append(pos)
+            self.grid.append(tuple(pos / 24))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __getstate__(self):
+
+        # Vectors can't be pickled, so positions are sent to worker processes
+        # as tuples and frozen into Vectors again there
+        return dict(self.__dict__, mm=[tuple(pos) for pos in self.mm])
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.mm = [mu.Vector(pos).freeze() for pos in state['mm']]
+
+
+def transition_table(G):
+    """
+    Given a map, return a table of the node each node moves to when a zone is
+    driven in a direction, as {node: {zone: {direction: next node}}}. Throws an
+    exception if a zone move is ambiguous or goes nowhere, so maps are checked
+    once when loaded rather than on every move.
+    """
+
+    table = {n: {} for n in G.nodes()}
+
+    for n1, neighbors in G.adj.items():
+        for n2, edge_data in neighbors.items():
+            for zone, direction in edge_data.items():
+
+                if n1 == n2:
+                    raise Exception('Node {} moves to itself in zone {} {}'.format(n1, zone, direction))
+
+                moves = table[n1].setdefault(zone, {})
+                if moves.get(direction, n2) != n2:
+                    raise Exception('Multiple moves possible from node {} in zone {} {}: {}'.format(
+                        n1, zone, direction, [moves[direction], n2]
+                    ))
+                moves[direction] = n2
+
+    return table
+
+
 def shortest_path(p1, p2):
 
     n1 = _get_node(*p1)[0]
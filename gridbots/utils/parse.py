@@ -26,9 +26,18 @@ def parse_jobs(jobs_data, job_types):
     return job_queue
 
 
-def parse_bots(bots_data, node_aliases, graph):
+def parse_bots(bots_data, node_aliases, graph, transitions=None, node_table=None, rotation_table=None):
 
-    from gridbots.core.bot import Bot
+    from gridbots.core.bot import Bot, RotationTable
+    from gridbots.utils.maputils import NodeTable, transition_table
+
+    # Shared by all bots
+    if transitions is None:
+        transitions = transition_table(graph)
+    if node_table is None:
+        node_table = NodeTable(graph)
+    if rotation_table is None:
+        rotation_table = RotationTable(node_table, transitions)
 
     bots = []
     for bot_name, bot_data in bots_data.items():
@@ -41,7 +50,10 @@ def parse_bots(bots_data, node_aliases, graph):
             node=bot_data['position'],
             rotation=bot_data['rotation'],
             bot_type=bot_data['type'],
-            graph=graph
+            graph=graph,
+            transitions=transitions,
+            node_table=node_table,
+            rotation_table=rotation_table
         )
         bots.append(bot)
 
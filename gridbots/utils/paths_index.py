@@ -0,0 +1,85 @@
+"""
+
+"""
+
+import os
+import bisect
+
+import yaml
+
+
+class PathsIndex():
+    """
+    Index of the paths files of a simulation, kept in index.yml next to them.
+    Each entry gives the file and first frame of a chunk, the first and last
+    recorded frames in it, its size in bytes and compression codec, and its
+    keyframes, which are complete states rather than changes from the previous
+    one. Any frame is then found without knowing how the states were split
+    into files, and rebuilt from the keyframe before it and at most one
+    keyframe interval of changes.
+
+    """
+
+    INDEX_FILE = 'index.yml'
+
+    def __init__(self, paths_dir):
+
+        self.paths_dir = paths_dir
+        self.index_file = os.path.join(paths_dir, self.INDEX_FILE)
+
+        self.chunks = []
+        if os.path.isfile(self.index_file):
+            with open(self.index_file) as f:
+                self.chunks = yaml.load(f.read()) or []
+
+    def save(self):
+
+        with open(self.index_file, 'w') as f:
+            f.write(yaml.dump(self.chunks))
+
+    def add(self, file_name, file_frame, frames, keyframes, size, codec):
+        """
+        Add a chunk written to file_name with the given recorded frames.
+        """
+
+        self.chunks.append({
+            'file': file_name,
+            'frame': file_frame,
+            'first_frame': min(frames) if frames else None,
+            'last_frame': max(frames) if frames else None,
+            'bytes': size,
+            'codec': codec,
+            'keyframes': sorted(keyframes)
+        })
+        self.save()
+
+    def remove(self, frame):
+        """
+        Drop the chunks from the given file frame on.
+        """
+
+        self.chunks = [c for c in self.chunks if c['frame'] < frame]
+        self.save()
+
+    def chunk(self, frame):
+        """
+        Return the entry of the chunk holding the given frame, or None.
+        """
+
+        i = bisect.bisect_right([c['frame'] for c in self.chunks], frame) - 1
+        return self.chunks[i] if i >= 0 else None
+
+    def keyframe(self, frame):
+        """
+        Return the last keyframe at or before the given frame, or None.
+        """
+
+        i = bisect.bisect_right([c['frame'] for c in self.chunks], frame) - 1
+        while i >= 0:
+            keyframes = self.chunks[i]['keyframes']
+            j = bisect.bisect_right(keyframes, frame) - 1
+            if j >= 0:
+                return keyframes[j]
+            i -= 1
+
+        return None
@@ -0,0 +1,118 @@
+"""
+
+"""
+
+import os
+import pickle
+import logging
+
+import gridbots
+
+
+class ScriptCache():
+    """
+    Cache of parsed script command trees, kept in memory and on disk. Each entry
+    records the digest of the script and of every script it includes, and is
+    only returned while all of those digests still match. The on-disk cache is
+    dropped if it was written with another CACHE_VERSION.
+
+    """
+
+    CACHE_PATH = os.path.join(gridbots.path, 'spec', 'cache', 'scripts.pickle')
+
+    # Bump whenever parsing or the command classes change, so that command
+    # trees pickled by an older parser are not used
+    CACHE_VERSION = 2
+
+    def __init__(self, path=CACHE_PATH):
+
+        self.logger = logging.getLogger(__name__)
+
+        # Location of the on-disk cache, or None to keep it in memory only
+        self.path = path
+
+        # Map of script name to (dependency digests, commands)
+        self.entries = {}
+
+        self.loaded = False
+        self.dirty = False
+
+    def load(self):
+
+        self.loaded = True
+
+        if not self.path or not os.path.isfile(self.path):
+            return
+
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            self.logger.warning('Could not read script cache %s: %s', self.path, e)
+            return
+
+        if not isinstance(data, dict) or data.get('version') != self.CACHE_VERSION:
+            self.logger.info('Dropping script cache %s from another version', self.path)
+            return
+
+        entries = data['entries']
+
+        # Entries parsed in this process take precedence
+        entries.update(self.entries)
+        self.entries = entries
+
+    def save(self):
+
+        if not self.path or not self.dirty:
+            return
+
+        data = {'version': self.CACHE_VERSION, 'entries': self.entries}
+
+        # Write to a temporary file first so readers never see a partial cache.
+        # If the cache can't be written, as in a read-only install, keep it in
+        # memory only.
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self.logger.warning('Could not write script cache %s, keeping it in memory: %s', self.path, e)
+            self.path = None
+
+        self.dirty = False
+
+    def get(self, script_name, digest):
+        """
+        Return (dependency digests, commands) for the given script if its cache
+        entry is still valid, else None. The digest function is called with the
+        name of each script the entry depends on.
+        """
+
+        if not self.loaded:
+            self.load()
+
+        if script_name not in self.entries:
+            return None
+
+        deps, commands = self.entries[script_name]
+
+        try:
+            if any(digest(name) != d for name, d in deps.items()):
+                return None
+        except FileNotFoundError:
+            return None
+
+        return deps, commands
+
+    def put(self, script_name, deps, commands):
+
+        self.entries[script_name] = (dict(deps), commands)
+        self.dirty = True
+
+
+# Shared between all trajectory builders in this process
+script_cache = ScriptCache()
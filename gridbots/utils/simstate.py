@@ -13,14 +13,14 @@ class SimulationState():
         self.bots = {}
         self.rods = {}
         self.structure = None
-        self.scripts = []
+        self.script_id = None
         self.time = None
 
     def set_bots(self, bots, prev=None):
 
         # self.bots = {b.name: (tuple(b.pos/24), b.rot) for b_name, b in bots.items()}
         for bot_name, bot in bots.items():
-            data = (tuple(bot.pos/24), bot.rot)
+            data = (bot.grid_pos, bot.rot)
             if not prev or data != prev.bots[bot_name]:
                 self.bots[bot_name] = data
 
@@ -32,12 +32,7 @@ class SimulationState():
             self.structure = structure_data
 
         for rod_id, rod in structure.rods.items():
-            rod_data = (
-                rod['bot'],
-                tuple(rod['pos']/24) if rod['pos'] is not None else None,
-                rod['rot'],
-                rod['done']
-            )
+            rod_data = self.rod_data(rod)
             if not prev or rod_id not in prev.rods or rod_data != prev.rods[rod_id]:
                 self.rods[rod_id] = rod_data
 
@@ -48,10 +43,20 @@ class SimulationState():
         #     rod['done']
         # ) for rod_id, rod in structure.rods.items()}
 
-    def set_scripts(self, scripts, time, prev=None):
+    @staticmethod
+    def rod_data(rod):
+        return (
+            rod['bot'],
+            tuple(rod['pos']/24) if rod['pos'] is not None else None,
+            rod['rot'],
+            rod['done']
+        )
 
-        if not prev or scripts != prev.scripts:
-            self.scripts = scripts
+    def set_scripts(self, script_id, time, prev=None):
+
+        # Script stacks are stored once in the metadata, states only hold an ID
+        if not prev or script_id != prev.script_id:
+            self.script_id = script_id
 
         if not prev or time != prev.time:
             self.time = time
@@ -62,7 +67,7 @@ class SimulationState():
             self.bots,
             self.rods,
             self.structure,
-            self.scripts,
+            self.script_id,
             self.time
         ))
 
@@ -73,6 +78,6 @@ class SimulationState():
         s.bots = data[1]
         s.rods = data[2]
         s.structure = data[3]
-        s.scripts = data[4]
+        s.script_id = data[4]
         s.time = data[5]
         return s
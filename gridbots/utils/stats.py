@@ -0,0 +1,177 @@
+"""
+
+"""
+
+import importlib
+
+import numpy as np
+
+
+def script_names(script):
+    """
+    Names of the scripts in a script stack, outermost first. Scripts running
+    side by side in a simscript are listed in order, and unnamed blocks are
+    skipped.
+    """
+
+    names = []
+    for s in script or ():
+        for name in (s if isinstance(s, tuple) else (s,)):
+            if name:
+                names.append(name)
+    return names
+
+
+class Accumulator():
+    """
+    Summary metric gathered while a simulation runs in stats-only mode, in
+    place of recording states. Subclasses set a name, which is the key of their
+    result in the stats file.
+
+    """
+
+    name = None
+
+    def __init__(self, sim):
+        self.sim = sim
+
+    def update(self, control_inputs, frames=1):
+        """
+        Called after the simulation applies the given control inputs, for the
+        given number of frames.
+        """
+        pass
+
+    def result(self):
+        """
+        Return the metric as plain data for the stats file.
+        """
+        return {}
+
+
+class ScriptTime(Accumulator):
+    """
+    Frames and simulated seconds spent in each script, including the scripts
+    it calls.
+
+    """
+
+    name = 'script_time'
+
+    def __init__(self, sim):
+
+        super(ScriptTime, self).__init__(sim)
+
+        # Frames under each script stack, rolled up into scripts at the end
+        self.stack_frames = {}
+
+    def update(self, control_inputs, frames=1):
+
+        script = control_inputs.get('script')
+        self.stack_frames[script] = self.stack_frames.get(script, 0) + frames
+
+    def result(self):
+
+        scripts = {}
+        for script, frames in self.stack_frames.items():
+            for name in set(script_names(script)) or ['unknown']:
+                if name not in scripts:
+                    scripts[name] = {'frames': 0, 'time': 0.0}
+                scripts[name]['frames'] += frames
+                scripts[name]['time'] += frames / self.sim.rate
+
+        return scripts
+
+
+class BotTravel(Accumulator):
+    """
+    Distance travelled by each bot, in mm.
+
+    """
+
+    name = 'bot_travel'
+
+    def __init__(self, sim):
+
+        super(BotTravel, self).__init__(sim)
+
+        self.node_pos = np.array(sim.node_table.mm, dtype=np.float32)
+        self.node_ids = self.bot_node_ids()
+        self.distance = np.zeros(len(sim.bots))
+
+    def bot_node_ids(self):
+
+        if self.sim.bot_array:
+            return self.sim.bot_array.node_ids.copy()
+
+        return np.array([b.node_id for b in self.sim.bots], dtype=np.int32)
+
+    def update(self, control_inputs, frames=1):
+
+        # Bots only move when a zone is driven
+        if not any(key in self.sim.zone_bots for key in control_inputs):
+            return
+
+        node_ids = self.bot_node_ids()
+        moved = np.nonzero(node_ids != self.node_ids)[0]
+        if len(moved):
+            steps = self.node_pos[node_ids[moved]] - self.node_pos[self.node_ids[moved]]
+            self.distance[moved] += np.linalg.norm(steps, axis=1)
+            self.node_ids = node_ids
+
+    def result(self):
+
+        travel = {b.name: float(d) for b, d in zip(self.sim.bots, self.distance)}
+        travel['total'] = float(self.distance.sum())
+        return travel
+
+
+class RodDetach(Accumulator):
+    """
+    Frame and simulated time at which each rod was detached by a UV cure.
+
+    """
+
+    name = 'rod_detach'
+
+    def __init__(self, sim):
+
+        super(RodDetach, self).__init__(sim)
+
+        self.detached = {}
+
+    def update(self, control_inputs, frames=1):
+
+        if 'uv' not in control_inputs:
+            return
+
+        for rod_id, rod in self.sim.structure.rods.items():
+            if rod['done'] and rod_id not in self.detached:
+                self.detached[rod_id] = {'frame': self.sim.frame, 'time': self.sim.time}
+
+    def result(self):
+        return self.detached
+
+
+# Accumulators by the name used in simulation files
+ACCUMULATORS = {
+    'script_time': ScriptTime,
+    'bot_travel': BotTravel,
+    'rod_detach': RodDetach
+}
+
+
+def get_accumulator(name):
+    """
+    Return the accumulator class with the given name, either a built-in one or
+    a dotted path to a subclass of Accumulator.
+    """
+
+    if name in ACCUMULATORS:
+        return ACCUMULATORS[name]
+
+    if '.' not in name:
+        raise Exception('Unknown accumulator: {}'.format(name))
+
+    module_name, class_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
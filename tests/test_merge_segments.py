@@ -0,0 +1,134 @@
+"""
+
+"""
+
+import unittest
+
+from gridbots.core.routine import TrajectoryBuilder
+
+merge_segments = TrajectoryBuilder.merge_segments
+
+
+def expand(segments):
+    """
+    Per-frame control inputs of a list of segments.
+    """
+    return [control_input for control_input, count in segments for i in range(count)]
+
+
+def merge_frames(children):
+    """
+    Per-frame merge of child segment lists, later children taking precedence.
+    """
+
+    frames = []
+    for child in children:
+        for i, control_input in enumerate(expand(child)):
+            if i < len(frames):
+                frames[i] = dict(frames[i], **control_input)
+            else:
+                frames.append(dict(control_input))
+
+    return frames
+
+
+class MergeSegmentsTest(unittest.TestCase):
+
+    def assertMerges(self, children):
+
+        merged = list(merge_segments(children))
+
+        self.assertEqual(expand(merged), merge_frames(children))
+        self.assertTrue(all(count > 0 for control_input, count in merged))
+
+        return merged
+
+    def test_empty(self):
+
+        self.assertEqual(list(merge_segments([])), [])
+        self.assertEqual(list(merge_segments([[], []])), [])
+
+    def test_single_child(self):
+
+        child = [({'Z01': '+X'}, 3), ({'waiting': 1.0}, 2)]
+        self.assertEqual(list(merge_segments([child])), child)
+
+    def test_staggered_boundaries(self):
+
+        self.assertMerges([
+            [({'Z01': '+X'}, 3), ({'Z01': '-Y'}, 4)],
+            [({'Z02': '+Y'}, 5), ({'waiting': 0.5}, 1)],
+            [({'Z03': '-X'}, 1), ({'Z03': '+X'}, 1), ({'Z03': '-X'}, 6)],
+        ])
+
+    def test_unequal_lengths(self):
+
+        merged = self.assertMerges([
+            [({'Z01': '+X'}, 2)],
+            [({'Z02': '+Y'}, 2), ({'Z02': '-Y'}, 3), ({'Z02': '+X'}, 4)],
+        ])
+
+        # Once one child is left its segments pass through
+        self.assertEqual(merged[-2:], [({'Z02': '-Y'}, 3), ({'Z02': '+X'}, 4)])
+
+    def test_empty_segments(self):
+
+        self.assertMerges([
+            [({'Z01': '+X'}, 0), ({'Z01': '-X'}, 2), ({'Z01': '+Y'}, 0)],
+            [({'Z02': '+Y'}, 1), ({'Z02': '-Y'}, 0), ({'Z02': '+X'}, 3)],
+        ])
+
+    def test_later_child_wins(self):
+
+        merged = self.assertMerges([
+            [({'waiting': 1.0, 'script': 'a'}, 2)],
+            [({'waiting': 2.0, 'script': 'b'}, 2)],
+        ])
+
+        self.assertEqual(merged, [({'waiting': 2.0, 'script': 'b'}, 2)])
+
+    def test_join_equal_spans(self):
+
+        # Boundaries in one child that do not change the merged input
+        merged = self.assertMerges([
+            [({'Z01': '+X'}, 2), ({'Z01': '+X'}, 3), ({'Z01': '-Y'}, 1)],
+            [({'Z02': '+Y'}, 1), ({'Z02': '+Y'}, 4), ({'Z02': '-X'}, 2)],
+        ])
+
+        self.assertEqual(merged, [
+            ({'Z01': '+X', 'Z02': '+Y'}, 5),
+            ({'Z01': '-Y', 'Z02': '-X'}, 1),
+            ({'Z02': '-X'}, 1),
+        ])
+
+    def test_same_zone_move(self):
+
+        # Both scripts driving a zone the same way is allowed
+        self.assertMerges([
+            [({'Z01': '+X'}, 3)],
+            [({'Z01': '+X'}, 2), ({'Z02': '-Y'}, 2)],
+        ])
+
+    def test_zone_conflict(self):
+
+        children = [
+            [({'Z01': '+X'}, 3)],
+            [({'Z02': '-Y'}, 2), ({'Z01': '-X'}, 2)],
+        ]
+
+        with self.assertRaisesRegex(RuntimeError, 'Conflicting moves for zone Z01'):
+            list(merge_segments(children))
+
+    def test_conflict_after_clean_frames(self):
+
+        children = [
+            [({'Z01': '+X'}, 2), ({'Z01': '+Y'}, 2)],
+            [({'Z02': '+X'}, 2), ({'Z01': '-Y'}, 2)],
+        ]
+
+        with self.assertRaisesRegex(RuntimeError, 'Z01 .*: \\+Y and -Y'):
+            list(merge_segments(children))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+"""
+
+"""
+
+import unittest
+
+from gridbots.core.routine import Command
+from gridbots.core.routine import SerialCommands
+from gridbots.core.routine import ParallelCommands
+from gridbots.core.routine import TrajectoryBuilder
+from gridbots.core.optimizer import ScriptOptimizer
+
+from tests.test_trajectory import BASELINE_SCRIPTS
+from tests.test_trajectory import load_baseline
+from tests.test_trajectory import run_lengths
+
+
+def zmove(zone, x, y):
+    return Command('zmove', [str(zone), str(x), str(y)])
+
+
+def frames(command):
+    """
+    Per-frame control inputs of a command tree, with wait times dropped since
+    a fused wait reports the total time.
+    """
+
+    # Expand the command tree directly, without reading a script file
+    builder = TrajectoryBuilder.__new__(TrajectoryBuilder)
+    builder.rate = TrajectoryBuilder.DEFAULT_RATE
+    builder.script_stacks = {}
+
+    return [strip_waits(control_input) for control_input in builder.iter_moves(command)]
+
+
+def strip_waits(control_input, keep_scripts=True):
+
+    control_input = dict(control_input)
+    for key in control_input:
+        if key == 'waiting' or key.startswith('zonewaiting'):
+            control_input[key] = None
+    if not keep_scripts:
+        control_input.pop('script', None)
+
+    return control_input
+
+
+class FuseZmovesTest(unittest.TestCase):
+
+    def test_same_direction(self):
+
+        fused = ScriptOptimizer.fuse_zmoves(zmove(3, 2, 0), zmove(3, 1.5, 0))
+        self.assertEqual(fused.name, 'zmove')
+        self.assertEqual(fused.args, ['3', '3.5', '0.0'])
+
+        fused = ScriptOptimizer.fuse_zmoves(zmove(3, 0, -1), zmove(3, 0, -2.5))
+        self.assertEqual(fused.args, ['3', '0.0', '-3.5'])
+
+    def test_x_then_y(self):
+
+        # x steps of the first move run before the y steps of the second
+        fused = ScriptOptimizer.fuse_zmoves(zmove(4, 1, 0), zmove(4, 2, -3))
+        self.assertEqual(fused.args, ['4', '3.0', '-3.0'])
+
+        fused = ScriptOptimizer.fuse_zmoves(zmove(4, -1, 2), zmove(4, 0, 0.5))
+        self.assertEqual(fused.args, ['4', '-1.0', '2.5'])
+
+    def test_not_fused(self):
+
+        cases = [
+            # Different zones
+            (zmove(1, 1, 0), zmove(2, 1, 0)),
+            # Opposite directions
+            (zmove(1, 1, 0), zmove(1, -1, 0)),
+            (zmove(1, 0, 2), zmove(1, 0, -2)),
+            # y steps of the first move would run after the x steps of the second
+            (zmove(1, 1, 1), zmove(1, 1, 0)),
+            (zmove(1, 0, 1), zmove(1, 1, 1)),
+        ]
+
+        for c1, c2 in cases:
+            with self.subTest(c1=c1, c2=c2):
+                self.assertIsNone(ScriptOptimizer.fuse_zmoves(c1, c2))
+
+    def test_same_frames(self):
+
+        pairs = [
+            (zmove(3, 2, 0), zmove(3, 1.5, 0)),
+            (zmove(4, 1, 0), zmove(4, 2, -3)),
+            (zmove(4, -1, 2), zmove(4, 0, 0.5)),
+            (zmove(5, 0.3, 0), zmove(5, 0.3, 0)),
+        ]
+
+        for c1, c2 in pairs:
+            with self.subTest(c1=c1, c2=c2):
+                fused = ScriptOptimizer.fuse_zmoves(c1, c2)
+                self.assertEqual(frames(SerialCommands('s', [fused])), frames(SerialCommands('s', [c1, c2])))
+
+
+class FuseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.optimizer = ScriptOptimizer()
+
+    def test_waits(self):
+
+        fused = self.optimizer.fuse(Command('wait', ['0.5']), Command('wait', ['0.25']))
+        self.assertEqual(fused.args, ['0.75'])
+
+        fused = self.optimizer.fuse(Command('zonewait', ['2', '1']), Command('zonewait', ['2', '0.5']))
+        self.assertEqual(fused.args, ['2', '1.5'])
+
+    def test_waits_not_fused(self):
+
+        cases = [
+            # Different zones
+            (Command('zonewait', ['2', '1']), Command('zonewait', ['3', '1'])),
+            # Different commands
+            (Command('wait', ['1']), Command('zonewait', ['3', '1'])),
+            # Rounding to whole frames differs, each wait is no frames but the sum is one
+            (Command('wait', ['0.005']), Command('wait', ['0.005'])),
+            # Commands that are not waits or moves
+            (Command('uv', ['1']), Command('uv', ['1'])),
+        ]
+
+        for c1, c2 in cases:
+            with self.subTest(c1=c1, c2=c2):
+                self.assertIsNone(self.optimizer.fuse(c1, c2))
+
+    def test_rate(self):
+
+        # At 120 Hz each wait is one frame and the sum two, at 150 Hz each
+        # wait still rounds down to one frame but the sum is three
+        waits = [Command('wait', ['0.01']), Command('wait', ['0.01'])]
+
+        optimized = ScriptOptimizer().optimize(SerialCommands('s', waits))
+        self.assertEqual(len(optimized), 1)
+
+        optimized = ScriptOptimizer().optimize(SerialCommands('s', [Command('rate', ['150'])] + waits))
+        self.assertEqual(len(optimized), 3)
+
+
+class OptimizeTest(unittest.TestCase):
+
+    def test_folding(self):
+
+        script = SerialCommands('s', [
+            Command('rate', ['100']),
+            zmove(1, 1, 0),
+            zmove(1, 0, 0),
+            zmove(1, 2, 0),
+            Command('wait', ['0.1']),
+            Command('wait', ['0']),
+            Command('wait', ['0.2']),
+            Command('uv', ['1']),
+            zmove(1, 1, 0),
+        ])
+
+        optimized = ScriptOptimizer().optimize(script)
+
+        self.assertEqual([c.name for c in optimized], ['rate', 'zmove', 'wait', 'uv', 'zmove'])
+        self.assertEqual(frames(optimized), frames(script))
+
+    def test_blocks_kept(self):
+
+        sub = SerialCommands('sub.txt', [zmove(1, 1, 0)])
+        script = SerialCommands('s', [
+            zmove(1, 1, 0),
+            sub,
+            ParallelCommands(['a.txt', 'b.txt'], [
+                SerialCommands('', [zmove(1, 1, 0), zmove(1, 1, 0)]),
+                SerialCommands('', [zmove(2, 0, 1)]),
+            ]),
+        ])
+
+        optimized = ScriptOptimizer().optimize(script)
+
+        self.assertEqual(len(optimized), 3)
+        self.assertEqual(len(optimized[2][0]), 1)
+        self.assertEqual(frames(optimized), frames(script))
+
+        # Inlining splices the include and fuses across it
+        inlined = ScriptOptimizer(inline_scripts=True).optimize(script)
+
+        self.assertEqual(len(inlined), 2)
+        self.assertEqual(
+            [strip_waits(c, keep_scripts=False) for c in frames(inlined)],
+            [strip_waits(c, keep_scripts=False) for c in frames(script)]
+        )
+
+    def test_shared_includes(self):
+
+        sub = SerialCommands('sub.txt', [Command('wait', ['0.5']), Command('wait', ['0.5'])])
+        script = SerialCommands('s', [sub, sub])
+
+        optimized = ScriptOptimizer().optimize(script)
+
+        self.assertIs(optimized[0], optimized[1])
+
+
+class BaselineTest(unittest.TestCase):
+    """
+    Compare the optimized expansion of real scripts against the per-frame
+    baseline.
+    """
+
+    def check(self, keep_scripts, **kwargs):
+
+        for script_name in BASELINE_SCRIPTS:
+            with self.subTest(script=script_name):
+
+                builder = TrajectoryBuilder(None, script_name, cache=None, **kwargs)
+
+                baseline = run_lengths(
+                    strip_waits(control_input, keep_scripts)
+                    for control_input, count in load_baseline(script_name)
+                    for i in range(count)
+                )
+                moves = run_lengths(strip_waits(control_input, keep_scripts) for control_input in builder.moves)
+
+                self.assertEqual(moves, baseline)
+
+    def test_optimize(self):
+        self.check(keep_scripts=True, optimize=True)
+
+    def test_inline_scripts(self):
+
+        self.check(keep_scripts=False, inline_scripts=True)
+
+        # An include that changes rate after a wait, which must still be
+        # judged at the rate in effect when it runs
+        script = SerialCommands('A.txt', [
+            SerialCommands('B.txt', [Command('wait', ['0.01']), Command('rate', ['50'])]),
+            Command('wait', ['1']),
+        ])
+
+        inlined = ScriptOptimizer(inline_scripts=True).optimize(script)
+
+        self.assertEqual([c.name for c in inlined], ['wait', 'rate', 'wait'])
+        self.assertEqual(len(frames(inlined)), 52)
+        self.assertEqual(
+            [strip_waits(c, keep_scripts=False) for c in frames(inlined)],
+            [strip_waits(c, keep_scripts=False) for c in frames(script)]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,349 @@
+"""
+
+"""
+
+import os
+import shutil
+import pickle
+import logging
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+import networkx as nx
+
+import gridbots
+from gridbots.core.routine import TrajectoryBuilder
+from gridbots.core.simulation import Simulation, FRAMES_PER_STATE
+from gridbots.core.parallel import ParallelRun
+from gridbots.utils.columns import PathColumns
+from gridbots.utils.events import EventLog
+from gridbots.utils.paths_index import PathsIndex
+from gridbots.utils.simstate import SimulationState
+from gridbots.utils.compression import decompress
+from gridbots.utils.script_cache import script_cache
+
+# Small enough that a run spans several paths files
+STATES_PER_FILE = 40
+
+# Node spacing of the zones bots drive in, half a millimeter in grid units
+STEP = 0.5 / 24
+
+# Node spacing of the rod track
+ROD_STEP = 40 / 24
+
+SCRIPTS = {
+    '_t_sub1.txt': ['zmove(1, 2, 0)', 'zmove(1, 0, 1.5)', 'zonewait(1, .1)', 'zmove(1, -2, -1.5)'],
+    '_t_sub2.txt': ['zmove(2, 0, 2)', 'wait(.2)', 'zmove(2, 0, -2)'],
+    '_t_rods.txt': [
+        'feed(h)', 'zmove(13, 5.5, 0)', 'zmove(13, 0, .5)', 'uv(1)', 'uv(0)',
+        'zmove(13, -5.5, 0)', 'zmove(13, 0, -.5)'
+    ],
+    '_t_late.txt': ['zmove(3, 1, 1)', 'wait(.5)', 'zmove(3, -1, -1)'],
+}
+
+# One block of the routine, which is repeated
+BLOCK = [
+    '<_t_sub1', 'wait(1)', 'simscript(_t_sub1, _t_sub2)', 'stagerel(0, 12, 0)', 'rate(80)',
+    '<_t_sub2', 'wait(.5)', 'rate(120)', '<_t_rods', 'zmove(3, 2, 2)', 'zmove(3, -2, -2)', 'wait(2)'
+]
+
+
+def node(zone, i, j):
+    return 'Z{:02}.P.{}.{}'.format(zone, i, j)
+
+
+def build_map():
+    """
+    Four zones of 6 x 6 nodes, and a rod track in zone 13 that reaches the
+    stage.
+    """
+
+    G = nx.DiGraph()
+
+    def add_grid(zone, nx_, ny, ox, oy, step):
+        name = 'Z{:02}'.format(zone)
+        for i in range(nx_):
+            for j in range(ny):
+                G.add_node(node(zone, i, j), x=ox + i * step, y=oy + j * STEP, z=0.0, zone=zone, pixel='P')
+        for i in range(nx_):
+            for j in range(ny):
+                if i + 1 < nx_:
+                    G.add_edge(node(zone, i, j), node(zone, i + 1, j), **{name: '+X'})
+                    G.add_edge(node(zone, i + 1, j), node(zone, i, j), **{name: '-X'})
+                if j + 1 < ny:
+                    G.add_edge(node(zone, i, j), node(zone, i, j + 1), **{name: '+Y'})
+                    G.add_edge(node(zone, i, j + 1), node(zone, i, j), **{name: '-Y'})
+
+    for zone in range(1, 5):
+        add_grid(zone, 6, 6, (zone - 1) * 8 * STEP, 0, STEP)
+
+    add_grid(13, 12, 2, -130 / 24, 125 / 24, ROD_STEP)
+
+    return G
+
+
+def write_fixture(root):
+
+    for d in ('maps', 'simulations', 'paths'):
+        os.makedirs(os.path.join(root, 'spec', d))
+    os.makedirs(os.path.join(root, 'sri-scripts'))
+
+    nx.write_gpickle(build_map(), os.path.join(root, 'spec', 'maps', '_test.gpickle'))
+
+    for name, lines in SCRIPTS.items():
+        write_script(root, name, lines)
+    write_script(root, '_t_main.txt', BLOCK * 4 + ['<_t_late'])
+
+
+def write_script(root, name, lines):
+    with open(os.path.join(root, 'sri-scripts', name), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def sim_data(**options):
+
+    aliases = {'rod_feed_tree': node(13, 0, 0), 'r1': node(13, 0, 0), 'r2': node(13, 5, 1)}
+    bots = {
+        'r1': {'position': 'r1', 'rotation': 0, 'type': 'bot_rod_h'},
+        'r2': {'position': 'r2', 'rotation': 0, 'type': 'bot_rod_h'}
+    }
+    for zone in range(1, 5):
+        for k, (i, j) in enumerate([(0, 0), (1, 2)]):
+            name = 'b{}{}'.format(zone, k)
+            aliases[name] = node(zone, i, j)
+            bots[name] = {'position': name, 'rotation': 0, 'type': 'bot_glue_dab'}
+
+    data = {
+        'controller': {'type': 'RoutineController', 'options': {'routine': '_t_main.txt'}},
+        'map': '_test',
+        'stage_pos': [299, 96, -20],
+        'bots': bots,
+        'node_aliases': aliases,
+        'bot_types': {'bot_glue_dab': {}, 'bot_rod_h': {}},
+        'boundary_scripts': ['_t_rods'],
+        'checkpoint_interval': 300
+    }
+    data.update(options)
+
+    return data
+
+
+class SimulationTest(unittest.TestCase):
+    """
+    Run a small simulation with each engine, output format and mode, and
+    compare the decoded states of every recorded frame with those of the
+    default run.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+
+        logging.disable(logging.WARNING)
+
+        cls.root = tempfile.mkdtemp()
+        write_fixture(cls.root)
+
+        cls.patches = [
+            mock.patch.object(gridbots, 'path', cls.root),
+            mock.patch.object(TrajectoryBuilder, 'SCRIPT_DIR', os.path.join(cls.root, 'sri-scripts')),
+            mock.patch.object(script_cache, 'path', None),
+            mock.patch('gridbots.core.simulation.STATES_PER_FILE', STATES_PER_FILE),
+            mock.patch('gridbots.core.parallel.STATES_PER_FILE', STATES_PER_FILE),
+        ]
+        for patch in cls.patches:
+            patch.start()
+
+        cls.meta, cls.states = cls.run_sim('default')
+
+    @classmethod
+    def tearDownClass(cls):
+
+        for patch in cls.patches:
+            patch.stop()
+
+        shutil.rmtree(cls.root)
+        logging.disable(logging.NOTSET)
+
+    @classmethod
+    def write_sim(cls, sim_name, **options):
+        path = os.path.join(cls.root, 'spec', 'simulations', '_test_{}.yml'.format(sim_name))
+        with open(path, 'w') as f:
+            f.write(yaml.dump(sim_data(**options)))
+        return '_test_{}'.format(sim_name)
+
+    @classmethod
+    def run_sim(cls, sim_name, processes=None, **options):
+
+        sim_name = cls.write_sim(sim_name, **options)
+
+        sim = Simulation(sim_name)
+        if processes:
+            ParallelRun(sim, processes).run()
+        else:
+            sim.run()
+
+        return cls.decode(sim_name)
+
+    @classmethod
+    def decode(cls, sim_name):
+        """
+        Read back the metadata of a run and the complete state of each recorded
+        frame.
+        """
+
+        paths_dir = os.path.join(cls.root, 'spec', 'paths', sim_name)
+        with open(os.path.join(paths_dir, 'meta.yml')) as f:
+            meta = yaml.load(f.read())
+
+        frames = range(0, meta['num_frames'], FRAMES_PER_STATE)
+        output_format = meta['format']
+
+        if output_format == 'columns':
+            reader = PathColumns(paths_dir, meta['bot_columns'])
+            states = [reader.state(frame) for frame in frames]
+
+        elif output_format == 'events':
+            reader = EventLog(paths_dir, meta['bot_columns'], meta['rate'])
+            states = [reader.state(frame) for frame in frames]
+
+        else:
+            # Apply the changes in each state to the complete one
+            serialized = {}
+            for chunk in PathsIndex(paths_dir).chunks:
+                with open(os.path.join(paths_dir, chunk['file']), 'rb') as f:
+                    serialized.update(pickle.loads(decompress(f.read(), chunk['codec'])))
+
+            full = SimulationState(0)
+            states = []
+            for frame in frames:
+                s = SimulationState.deserialize(serialized[frame])
+                full.bots.update(s.bots)
+                full.rods.update(s.rods)
+                for name in ('structure', 'script_id', 'time'):
+                    if getattr(s, name) is not None:
+                        setattr(full, name, getattr(s, name))
+                states.append(SimulationState.deserialize(full.serialize()))
+
+        return meta, [(
+            frame,
+            s.bots,
+            s.rods,
+            s.structure,
+            meta['scripts'][s.script_id],
+            round(s.time, 6)
+        ) for frame, s in zip(frames, states)]
+
+    def assertSameStates(self, result, meta=None, states=None):
+
+        meta = meta or self.meta
+        states = states or self.states
+
+        self.assertEqual(result[0]['num_frames'], meta['num_frames'])
+        self.assertAlmostEqual(result[0]['end_time'], meta['end_time'])
+        self.assertEqual(len(result[1]), len(states))
+        for s1, s2 in zip(result[1], states):
+            self.assertEqual(s1, s2, 'frame {}'.format(s1[0]))
+
+    def test_fixture(self):
+
+        # The routine moves bots and rods, and spans several paths files
+        meta, states = self.meta, self.states
+        self.assertGreater(len(states), 3 * STATES_PER_FILE)
+        self.assertNotEqual(states[0][1], states[-1][1])
+        self.assertTrue(any(rod[3] for rod in states[-1][2].values()))
+        self.assertGreater(len(PathsIndex(os.path.join(self.root, 'spec', 'paths', '_test_default')).chunks), 3)
+
+    def test_engines(self):
+
+        for engine in ('numpy', 'tracks'):
+            with self.subTest(engine=engine):
+                self.assertSameStates(self.run_sim(engine, engine=engine, track_processes=2))
+
+    def test_fast_forward(self):
+
+        for engine in ('bots', 'numpy', 'tracks'):
+            with self.subTest(engine=engine):
+                self.assertSameStates(self.run_sim(
+                    'ff_' + engine, engine=engine, fast_forward=True, track_processes=2
+                ))
+
+    def test_output_formats(self):
+
+        for output_format in ('columns', 'events'):
+            for fast_forward in (False, True):
+                with self.subTest(output_format=output_format, fast_forward=fast_forward):
+                    self.assertSameStates(self.run_sim(
+                        '{}_{}'.format(output_format, fast_forward),
+                        output_format=output_format, fast_forward=fast_forward
+                    ))
+
+    def test_keyframes_and_compression(self):
+
+        for keyframe_interval, compression in ((0, 'none'), (7, 'bz2'), (1, 'lzma')):
+            with self.subTest(keyframe_interval=keyframe_interval, compression=compression):
+                self.assertSameStates(self.run_sim(
+                    'kf_{}_{}'.format(keyframe_interval, compression),
+                    keyframe_interval=keyframe_interval, compression=compression
+                ))
+
+        self.assertSameStates(self.run_sim('columns_bz2', output_format='columns', compression='bz2'))
+
+    def test_parallel(self):
+
+        for output_format in ('pickle', 'columns', 'events'):
+            with self.subTest(output_format=output_format):
+                self.assertSameStates(self.run_sim(
+                    'parallel_' + output_format, processes=2, output_format=output_format
+                ))
+
+    def test_resume(self):
+
+        sim_name = self.write_sim('resume')
+        Simulation(sim_name).run()
+
+        for start_frame in (1000, 333, 0):
+            with self.subTest(start_frame=start_frame):
+                Simulation(sim_name, resume=True, start_frame=start_frame).run()
+                self.assertSameStates(self.decode(sim_name))
+
+    def test_incremental(self):
+
+        late = SCRIPTS['_t_late.txt']
+        write_script(self.root, '_t_late_inc.txt', late)
+        write_script(self.root, '_t_main_inc.txt', BLOCK * 4 + ['<_t_late_inc'])
+
+        options = {'controller': {'type': 'RoutineController', 'options': {'routine': '_t_main_inc.txt'}}}
+        sim_name = self.write_sim('incremental', **options)
+        Simulation(sim_name).run()
+        first = self.decode(sim_name)
+
+        # Nothing changed
+        Simulation(sim_name, incremental=True).run()
+        self.assertSameStates(self.decode(sim_name), *first)
+
+        # Edit the last script, and compare with a run from scratch
+        write_script(self.root, '_t_late_inc.txt', late[:1] + ['wait(1.5)', 'zmove(4, 1, 0)'] + late[1:])
+        Simulation(sim_name, incremental=True).run()
+
+        self.assertSameStates(self.decode(sim_name), *self.run_sim('incremental_fresh', **options))
+
+    def test_stats_only(self):
+
+        sim_name = self.write_sim('stats')
+        Simulation(sim_name, stats_only=True).run()
+
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'spec', 'paths', sim_name, 'meta.yml')))
+
+        with open(os.path.join(self.root, 'spec', 'stats', '{}.yml'.format(sim_name))) as f:
+            stats = yaml.load(f.read())
+
+        self.assertEqual(stats['num_frames'], self.meta['num_frames'])
+        self.assertAlmostEqual(stats['end_time'], self.meta['end_time'])
+        self.assertEqual(set(stats['stats']), set(Simulation.DEFAULT_STATS))
+        self.assertEqual(stats['num_rods_done'], sum(1 for rod in self.states[-1][2].values() if rod[3]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+"""
+
+"""
+
+import os
+import json
+import unittest
+
+from gridbots.core.routine import Trajectory
+from gridbots.core.routine import TrajectoryBuilder
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+# Scripts with a per-frame expansion recorded from the list-of-dicts builder,
+# as run-length encoded [control input, frame count] pairs
+BASELINE_SCRIPTS = [
+    'alignall.txt',
+    'buffer_advance.txt',
+    'unit1_getglue.txt',
+    'unit1_tree_int.txt',
+]
+
+
+def load_baseline(script_name):
+
+    path = os.path.join(DATA_DIR, script_name.replace('.txt', '.json'))
+    with open(path, 'r') as f:
+        return [(control_input, count) for control_input, count in json.load(f)]
+
+
+def plain(control_input):
+    """
+    Control input with script stacks as nested lists, as stored in the
+    baseline files.
+    """
+    return json.loads(json.dumps(control_input))
+
+
+def run_lengths(moves):
+    """
+    Run-length encode a sequence of per-frame control inputs.
+    """
+
+    segments = []
+    for control_input in moves:
+        control_input = plain(control_input)
+        if segments and segments[-1][0] == control_input:
+            segments[-1] = (control_input, segments[-1][1] + 1)
+        else:
+            segments.append((control_input, 1))
+
+    return segments
+
+
+class TrajectoryTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.a = {'Z01': '+X'}
+        self.b = {'waiting': 0.5}
+        self.c = {'Z02': '-Y'}
+
+        inner = Trajectory()
+        inner.append(self.b, 2)
+        inner.append(self.c, 1)
+
+        # a a a | b b c | c c | b b c
+        self.trajectory = Trajectory()
+        self.trajectory.append(self.a, 3)
+        self.trajectory.append_trajectory(inner)
+        self.trajectory.append(self.c, 2)
+        self.trajectory.append(self.a, 0)
+        self.trajectory.append_trajectory(Trajectory())
+        self.trajectory.append_trajectory(inner)
+
+        self.frames = [self.a] * 3 + [self.b] * 2 + [self.c] * 3 + [self.b] * 2 + [self.c]
+
+    def test_len(self):
+
+        self.assertEqual(len(Trajectory()), 0)
+        self.assertEqual(len(self.trajectory), len(self.frames))
+
+    def test_getitem(self):
+
+        for frame, control_input in enumerate(self.frames):
+            self.assertIs(self.trajectory[frame], control_input)
+
+    def test_span(self):
+
+        # Frames to the end of each segment, counting back from its last frame
+        remaining = [3, 2, 1, 2, 1, 1, 2, 1, 2, 1, 1]
+
+        for frame, control_input in enumerate(self.frames):
+            self.assertEqual(self.trajectory.span(frame), (control_input, remaining[frame]))
+
+    def test_out_of_range(self):
+
+        for frame in [-1, len(self.frames)]:
+            with self.assertRaises(IndexError):
+                self.trajectory[frame]
+            with self.assertRaises(IndexError):
+                self.trajectory.span(frame)
+
+        with self.assertRaises(IndexError):
+            Trajectory()[0]
+
+    def test_iter(self):
+
+        self.assertEqual(list(self.trajectory), self.frames)
+
+    def test_segments(self):
+
+        self.assertEqual(list(self.trajectory.segments()), [
+            (self.a, 3), (self.b, 2), (self.c, 1), (self.c, 2), (self.b, 2), (self.c, 1)
+        ])
+
+    def test_extend(self):
+
+        trajectory = Trajectory()
+        trajectory.extend(self.trajectory)
+
+        self.assertEqual(list(trajectory), self.frames)
+        self.assertFalse(any(isinstance(node, Trajectory) for node in trajectory.inputs))
+
+
+class BaselineTest(unittest.TestCase):
+    """
+    Compare the expansion of real scripts against the per-frame baseline.
+    """
+
+    def builder(self, script_name, **kwargs):
+        return TrajectoryBuilder(None, script_name, cache=None, **kwargs)
+
+    def test_eager(self):
+
+        for script_name in BASELINE_SCRIPTS:
+            with self.subTest(script=script_name):
+                baseline = load_baseline(script_name)
+                moves = self.builder(script_name).moves
+                self.assertEqual(run_lengths(moves), baseline)
+
+    def test_random_access(self):
+
+        for script_name in BASELINE_SCRIPTS:
+            with self.subTest(script=script_name):
+                baseline = load_baseline(script_name)
+                moves = self.builder(script_name).moves
+
+                # First and last frame of every baseline run
+                frame = 0
+                for control_input, count in baseline:
+                    self.assertEqual(plain(moves[frame]), control_input)
+                    self.assertEqual(plain(moves[frame + count - 1]), control_input)
+                    self.assertGreaterEqual(moves.span(frame)[1], 1)
+                    self.assertLessEqual(moves.span(frame)[1], count)
+                    frame += count
+
+                self.assertEqual(len(moves), frame)
+
+    def test_lazy(self):
+
+        for script_name in BASELINE_SCRIPTS:
+            with self.subTest(script=script_name):
+                builder = self.builder(script_name, lazy=True)
+                self.assertIsNone(builder.moves)
+                self.assertEqual(run_lengths(builder.iter_moves()), load_baseline(script_name))
+
+
+if __name__ == '__main__':
+    unittest.main()